@@ -5,17 +5,12 @@ import theano
 import theano.tensor as tensor
 import numpy
 
-# name(hyperp, tparams, grads, inputs (list), output(list), additional_updates (list of tuples, like batchnorm)) = f_grad_shared, f_update
-def adam(lr, tparams, grads, inp, cost, ups=None):
-	gshared = [theano.shared(p.get_value() * 0., name='%s_grad'%k) for k, p in tparams.iteritems()]
-	gsup = [(gs, g) for gs, g in zip(gshared, grads)]
+from utils import compile_multistep
 
-	if ups is not None:
-		f_grad_shared = theano.function(inp, cost, updates=gsup + ups, on_unused_input='ignore', profile=False)
-	else:
-		f_grad_shared = theano.function(inp, cost, updates=gsup, on_unused_input='ignore', profile=False)
-
-	lr0 = lr
+def adam_updates(lr, tparams, grads):
+	'''
+	Adam moment and parameter updates (list of tuples) for the given gradients
+	'''
 	b1 = 0.1
 	b2 = 0.001
 	e = 1e-8
@@ -26,9 +21,9 @@ def adam(lr, tparams, grads, inp, cost, ups=None):
 	i_t = i + 1.
 	fix1 = 1. - b1**(i_t)
 	fix2 = 1. - b2**(i_t)
-	lr_t = lr0 * (tensor.sqrt(fix2) / fix1)
+	lr_t = lr * (tensor.sqrt(fix2) / fix1)
 
-	for p, g in zip(tparams.values(), gshared):
+	for p, g in zip(tparams.values(), grads):
 		m = theano.shared(p.get_value() * 0.)
 		v = theano.shared(p.get_value() * 0.)
 		m_t = (b1 * g) + ((1. - b1) * m)
@@ -40,6 +35,51 @@ def adam(lr, tparams, grads, inp, cost, ups=None):
 		updates.append((p, p_t))
 	updates.append((i, i_t))
 
+	return updates
+
+# name(hyperp, tparams, grads, inputs (list), output(list), additional_updates (list of tuples, like batchnorm)) = f_grad_shared, f_update
+def adam(lr, tparams, grads, inp, cost, ups=None):
+	gshared = [theano.shared(p.get_value() * 0., name='%s_grad'%k) for k, p in tparams.iteritems()]
+	gsup = [(gs, g) for gs, g in zip(gshared, grads)]
+
+	if ups is not None:
+		f_grad_shared = theano.function(inp, cost, updates=gsup + ups, on_unused_input='ignore', profile=False)
+	else:
+		f_grad_shared = theano.function(inp, cost, updates=gsup, on_unused_input='ignore', profile=False)
+
+	updates = adam_updates(lr, tparams, gshared)
+
 	f_update = theano.function([lr], [], updates=updates, on_unused_input='ignore', profile=False)
 
-	return f_grad_shared, f_update
\ No newline at end of file
+	return f_grad_shared, f_update
+
+# name(shared learning rate, tparams, grads, inputs (list), output(list), additional_updates (list of tuples, like batchnorm)) = f_step
+def adam_step(lr, tparams, grads, inp, cost, ups=None):
+	'''
+	Single function version of adam: the moments and the parameters are updated directly from the
+	symbolic gradients in the same call that computes the cost, without going through gradient buffers.
+	lr is a shared variable, change it with set_value.
+	'''
+	updates = adam_updates(lr, tparams, grads)
+	if ups is not None:
+		updates += ups
+
+	f_step = theano.function(inp, cost, updates=updates, on_unused_input='ignore', profile=False)
+
+	return f_step
+
+# name(shared learning rate, tparams, grads, inputs (list), output(list), steps per call, additional_updates (list of tuples, like batchnorm)) = f_step, f_multi_step
+def adam_multistep(lr, tparams, grads, inp, cost, num_steps, ups=None):
+	'''
+	Multi-step version of adam_step. f_multi_step takes every input stacked over num_steps minibatches,
+	runs that many updates in one call and returns each output as a vector over the steps.
+	f_step is the single step function sharing the same optimizer state, for batches left over.
+	'''
+	updates = adam_updates(lr, tparams, grads)
+	if ups is not None:
+		updates += ups
+
+	f_step = theano.function(inp, cost, updates=updates, on_unused_input='ignore', profile=False)
+	f_multi_step = compile_multistep(inp, cost, updates, num_steps)
+
+	return f_step, f_multi_step
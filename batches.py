@@ -0,0 +1,180 @@
+import atexit
+import threading
+import Queue
+import numpy as np
+
+class BatchIterator():
+	'''
+	Shuffled minibatches of example indices, prepared by a background thread.
+	The thread draws each epoch's permutation ahead of time and hands out the batches as
+	ready int64 arrays through a bounded queue, so the training loop only has to pick them up.
+	'''
+	def __init__(self, num_examples, batch_size, prefetch=10, seed=None):
+		self.num_examples = num_examples
+		self.batch_size = batch_size
+		self.num_batches = num_examples / batch_size
+		self.rng = np.random.RandomState(seed)
+
+		# permutation of the epoch currently being consumed, and the random states
+		# before (replays this epoch) and after it was drawn (continues with the next one)
+		self.permutation = None
+		self.start_state = None
+		self.end_state = None
+
+		self.queue = Queue.Queue(maxsize=prefetch)
+		self._start()
+
+		# the producer must not be left blocked on the queue during interpreter shutdown
+		atexit.register(self.close)
+
+	def _start(self):
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self._produce)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _produce(self):
+		while not self.stopped.is_set():
+			start_state = self.rng.get_state()
+			permutation = self.rng.permutation(self.num_examples).astype(np.int64)
+			states = (start_state, self.rng.get_state())
+			for batch_id in range(self.num_batches):
+				self.queue.put((states, permutation, permutation[batch_id*self.batch_size:(batch_id+1)*self.batch_size]))
+				if self.stopped.is_set():
+					return
+
+	def epoch(self, skip=0):
+		'''
+		Yields the index arrays of the minibatches for the next epoch, incomplete batches are dropped.
+		The first skip batches are drawn but not returned (to continue an interrupted epoch).
+		'''
+		for batch_id in range(self.num_batches):
+			(self.start_state, self.end_state), self.permutation, idlist = self.queue.get()
+			if batch_id >= skip:
+				yield idlist
+
+	def restart(self, rng_state):
+		'''
+		Discards the prepared batches and continues from the given random state (start_state or end_state of an earlier run)
+		'''
+		self.close()
+		self.rng.set_state(rng_state)
+		self._start()
+
+	def close(self):
+		'''
+		Stops the background thread
+		'''
+		self.stopped.set()
+
+		# drain the queue so that a producer waiting on it can return, then drop what it put last
+		self._drain()
+		self.thread.join()
+		self._drain()
+
+	def _drain(self):
+		try:
+			while True:
+				self.queue.get_nowait()
+		except Queue.Empty:
+			pass
+
+class ShuffleBuffer():
+	'''
+	Shuffled minibatches from a stream of chunks, for datasets that do not fit in memory.
+	Rows are held in a buffer of fixed capacity. Every cycle, the occupied slots are shuffled, the first
+	half of them is handed out as minibatches and refilled from the stream, so memory use only depends
+	on buffer_size and each row leaves the buffer at a random position relative to its neighbours in the file.
+	'''
+	def __init__(self, chunks, batch_size, buffer_size, seed=None):
+		'''
+		chunks: callable returning a new iterator over the stream for every epoch, each chunk
+				being a tuple of arrays with the same number of rows (such as read_mnist.read_chunks)
+		'''
+		self.chunks = chunks
+		self.batch_size = batch_size
+		self.buffer_size = max(buffer_size, 2 * batch_size)
+		self.rng = np.random.RandomState(seed)
+		self.buffer = None
+
+		# random states at the start (replays this epoch) and at the end of the last epoch
+		self.start_state = None
+		self.end_state = None
+
+		# rows read from the stream that did not fit into the buffer yet
+		self.pending = None
+
+	def _rows(self, stream):
+		'''
+		Re-slices the stream into blocks of at most self.batch_size rows
+		'''
+		for chunk in stream:
+			for start in range(0, len(chunk[0]), self.batch_size):
+				yield tuple(part[start:start + self.batch_size] for part in chunk)
+
+	def _fill(self, rows, slots):
+		'''
+		Copies rows from the stream into the given buffer slots, returns the slots that were filled
+		'''
+		filled = 0
+		while filled < len(slots):
+			if self.pending is None:
+				self.pending = next(rows, None)
+				if self.pending is None:
+					break
+
+			size = min(len(slots) - filled, len(self.pending[0]))
+			for buf, part in zip(self.buffer, self.pending):
+				buf[slots[filled:filled + size]] = part[:size]
+
+			self.pending = tuple(part[size:] for part in self.pending)
+			if len(self.pending[0]) == 0:
+				self.pending = None
+			filled += size
+
+		return slots[:filled]
+
+	def epoch(self, skip=0):
+		'''
+		Yields tuples of arrays, one minibatch at a time, for a single pass over the stream.
+		Incomplete batches at the end of the stream are dropped. The first skip batches are
+		drawn but not returned (to continue an interrupted epoch).
+		'''
+		for batch_id, batch in enumerate(self._epoch()):
+			if batch_id >= skip:
+				yield batch
+		self.end_state = self.rng.get_state()
+
+	def restart(self, rng_state):
+		'''
+		Continues from the given random state (start_state or end_state of an earlier run)
+		'''
+		self.rng.set_state(rng_state)
+
+	def _epoch(self):
+		self.start_state = self.rng.get_state()
+		rows = self._rows(self.chunks())
+		self.pending = next(rows, None)
+		if self.pending is None:
+			return
+
+		if self.buffer is None:
+			self.buffer = tuple(np.empty((self.buffer_size,) + part.shape[1:], dtype=part.dtype) for part in self.pending)
+
+		active = self._fill(rows, np.arange(self.buffer_size))
+		exhausted = len(active) < self.buffer_size
+		while len(active) >= self.batch_size:
+			self.rng.shuffle(active)
+			if exhausted:
+				num_out = len(active) / self.batch_size * self.batch_size
+			else:
+				num_out = max(len(active) / 2 / self.batch_size, 1) * self.batch_size
+
+			out = active[:num_out]
+			for start in range(0, num_out, self.batch_size):
+				# fancy indexing copies, so the buffer can be refilled while the batch is in use
+				yield tuple(buf[out[start:start + self.batch_size]] for buf in self.buffer)
+
+			refilled = self._fill(rows, out)
+			exhausted = exhausted or len(refilled) < num_out
+			active = np.concatenate([active[num_out:], refilled])
@@ -0,0 +1,63 @@
+import os
+import cPickle
+import atexit
+import threading
+import Queue
+import numpy as np
+
+class CheckpointWriter():
+	'''
+	Writes checkpoints from a background thread. save() only queues the arrays it is given
+	(snapshots taken with get_value(), which copies), so training continues while the file is written.
+	The queue is bounded: if the disk falls behind, save() waits instead of piling up snapshots.
+	Every file is written under a temporary name and renamed, so a checkpoint is either complete or absent.
+	'''
+	def __init__(self, max_pending=2):
+		self.queue = Queue.Queue(maxsize=max_pending)
+		self.thread = threading.Thread(target=self._write)
+		self.thread.daemon = True
+		self.thread.start()
+		self.closed = False
+
+		# pending checkpoints are written out if the script ends without closing the writer
+		atexit.register(self.close)
+
+	def _write(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				break
+
+			fname, dump = item
+			tmp = fname + '.tmp'
+			try:
+				with open(tmp, 'wb') as f:
+					dump(f)
+					f.flush()
+					os.fsync(f.fileno())
+				os.rename(tmp, fname)
+			except (IOError, OSError) as e:
+				print "Could not write checkpoint " + fname + ": " + str(e)
+
+	def save(self, fname, params):
+		'''
+		Queues a dictionary of arrays to be written to fname
+		'''
+		self.queue.put((fname, lambda f: np.savez(f, **params)))
+
+	def save_state(self, fname, state):
+		'''
+		Queues a picklable object (such as a training state from trainstate.capture) to be written to fname
+		'''
+		self.queue.put((fname, lambda f: cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)))
+
+	def close(self):
+		'''
+		Waits for the pending checkpoints to be written
+		'''
+		if self.closed:
+			return
+
+		self.closed = True
+		self.queue.put(None)
+		self.thread.join()
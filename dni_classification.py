@@ -1,11 +1,15 @@
 import sys
 
 import numpy as np
-from read_mnist import read, show
+from read_mnist import read_arrays, show
 import theano
 import theano.tensor as T
 from utils import init_weights, _concat
-from adam import adam
+from adam import adam, adam_step
+from batches import BatchIterator
+from metrics import MetricsLogger
+from checkpoint import CheckpointWriter
+from parallel import Pipeline
 
 from collections import OrderedDict
 import time
@@ -25,6 +29,11 @@ learning_rate = 0.001
 train_rou = 'synthetic_gradients'
 code = 'sg_relu_reg_0.5'
 
+# synthetic gradients only: train every layer (with its synthetic gradient module) in a process of its own, as a stage of
+# a pipeline (1) or the whole network in a single step (0), and the number of minibatches queued between two stages
+pipelined = 0
+pipeline_depth = 2
+
 # regularization
 lmbda = 0.5
 
@@ -84,15 +93,6 @@ def synth_grad(tparams, prefix, activation, labels_one_hot):
 
 	return T.dot(activation, tparams[_concat(prefix, 'W')]) + T.dot(labels_one_hot, tparams[_concat(prefix, 'C')]) + tparams[_concat(prefix, 'b')]
 
-print "Getting data"
-# collect training data and labels and does row major flattening
-tri = np.asarray([img.flatten() for lbl, img in read(dataset='training', path ='MNIST/')], dtype=np.float32)
-trl = np.asarray([lbl for lbl, img in read(dataset='training', path ='MNIST/')], dtype=np.int64)
-
-# collect test data and label and does row major flattening
-tei = np.asarray([img.flatten() for lbl, img in read(dataset='testing', path = 'MNIST/')], dtype=np.float32)
-tel = np.asarray([lbl for lbl, img in read(dataset='testing', path = 'MNIST/')], dtype=np.int64)
-
 print "Initializing parameters"
 
 ff = 'ff'
@@ -120,6 +120,10 @@ for key, val in params.iteritems():
 
 # Training graph
 if len(sys.argv) < 2 or int(sys.argv[1]) == 0:
+	print "Getting data"
+	# collect training data and labels and does row major flattening
+	trl, tri = read_arrays(dataset='training', path='MNIST/')
+
 	print "Constructing the training graph"
 
 	train_data = theano.shared(tri, name='train_data')
@@ -128,12 +132,16 @@ if len(sys.argv) < 2 or int(sys.argv[1]) == 0:
 	# pass a batch of indices
 	img_ids = T.vector('ids', dtype='int64')
 	img = train_data[img_ids, :]
-	lbl = train_labels[img_ids, :]
+	lbl = train_labels[img_ids]
 	if train_rou == 'synthetic_gradients':
 		lbl_one_hot = T.extra_ops.to_one_hot(lbl, 10, dtype='float32')
 
 # Test graph
 else:
+	print "Getting data"
+	# collect test data and label and does row major flattening
+	tel, tei = read_arrays(dataset='testing', path='MNIST/')
+
 	print "Constructing the test graph"
 
 	test_data = theano.shared(tei, name='test_data')
@@ -142,7 +150,7 @@ else:
 	# pass a batch of indices
 	img_ids = T.vector('ids', dtype='int64')
 	img = test_data[img_ids, :]
-	lbl = test_labels[img_ids, :]
+	lbl = test_labels[img_ids]
 
 out1 = fflayer(tparams, img, _concat(ff, '1'), nonlin='relu')
 out2 = fflayer(tparams, out1, _concat(ff, '2'), nonlin='relu')
@@ -208,6 +216,52 @@ if len(sys.argv) < 2 or int(sys.argv[1]) == 0:
 	if train_rou == 'backprop':
 		f_grad_shared, f_update = adam(lr, tparams, grads, inps, loss)
 	
+	elif train_rou == 'synthetic_gradients' and pipelined:
+		# every stage takes the activations of the previous one, updates its layer with the synthetic gradient wrt its
+		# output (the true gradient for the output layer) and returns the gradient wrt its input, on which the previous
+		# stage trains its synthetic gradient module. The regularization of every layer is added in its own stage.
+		if theano.config.device != 'cpu':
+			# the forked stages cannot use the device context of this process
+			raise ValueError, "The pipelined routine runs its stages in forked processes and is CPU only, use device=cpu"
+		lr = theano.shared(np.float32(learning_rate), name='learning_rate')
+		layers = [_concat(ff, '1'), _concat(ff, '2'), _concat(ff, 'o')]
+		stages = []
+		inp = img
+		for k, layer in enumerate(layers):
+			stage_params = OrderedDict((key, tparams[_concat(layer, key)]) for key in ['W', 'b'])
+			reg = lmbda * ((stage_params['W'] ** 2).sum() + (stage_params['b'] ** 2).sum())
+			wrt = stage_params.values() + ([inp] if k > 0 else [])
+
+			if k < len(layers) - 1:
+				out = fflayer(tparams, inp, layer, nonlin='relu')
+				stage_grads = T.grad(reg, wrt=wrt, known_grads={out: synth_grad(tparams, _concat(sg, str(k + 1)), out, lbl_one_hot)})
+				stage_outs = [out] + stage_grads[2:] + [reg]
+			else:
+				stage_loss = T.nnet.nnet.categorical_crossentropy(T.nnet.nnet.softmax(fflayer(tparams, inp, layer, nonlin=None)), lbl).sum() + reg
+				stage_grads = T.grad(stage_loss, wrt=wrt)
+				stage_outs = stage_grads[2:] + [stage_loss]
+
+			f_stage = adam_step(lr, stage_params, stage_grads[:2], ([img_ids, inp] if k > 0 else [img_ids]), stage_outs)
+			variables = stage_params.values()
+
+			f_stage_sg = None
+			if k < len(layers) - 1:
+				# synthetic gradient module of the stage, trained on its activations and the gradient wrt them
+				h = T.matrix(_concat('activation', str(k + 1)), dtype='float32')
+				target = T.matrix(_concat('ssgrad', str(k + 1)), dtype='float32')
+				stage_loss_sg = 0.5 * ((target - synth_grad(tparams, _concat(sg, str(k + 1)), h, lbl_one_hot)) ** 2).sum()
+				sg_params = OrderedDict((key, tparams[_concat(_concat(sg, str(k + 1)), key)]) for key in ['W', 'C', 'b'])
+				f_stage_sg = adam_step(lr, sg_params, T.grad(stage_loss_sg, wrt=sg_params.values()), [img_ids, h, target], stage_loss_sg)
+				variables += sg_params.values()
+
+				# the next stage takes the activations as an input
+				inp = T.matrix(_concat('h', str(k + 1)), dtype='float32')
+
+			stages.append((f_stage, f_stage_sg, variables))
+
+		pipeline = Pipeline(stages, pipeline_depth)
+		pipeline.start()
+
 	elif train_rou == 'synthetic_gradients':
 		
 		# split params for sg modules and network
@@ -223,23 +277,36 @@ if len(sys.argv) < 2 or int(sys.argv[1]) == 0:
 		f_grad_shared_sg, f_update_sg = adam(lr, tparams_sg, grads_sg, inps + inps_sg, loss_sg)
 
 	print "Training"
-	cost_report = open('./Results/classification/' + train_rou + '/training_' + code + '_' + str(batch_size) + '_' + str(learning_rate) + '.txt', 'w')
-	id_order = range(len(tri))
+	# shuffled minibatches are prepared by a background thread while the compiled functions run
+	batches = BatchIterator(len(tri), batch_size)
+	# binary records, buffered in memory and written by a background thread
+	cost_report = MetricsLogger('./Results/classification/' + train_rou + '/training_' + code + '_' + str(batch_size) + '_' + str(learning_rate) + '.bin', ['epoch', 'batch', 'cost', 'time'], batch_size=batch_size, steps_per_epoch=batches.num_batches)
+	# checkpoints are written by a background thread
+	checkpoints = CheckpointWriter()
 
 	min_cost = 100000.0
 	epoch = 0
+	# pipeline: minibatches on their way through the stages, and the synthetic gradient costs counted so far
+	in_flight = []
+	sg_total = 0.
 	while condition == False:
 		print "Epoch " + str(epoch + 1),
 
-		np.random.shuffle(id_order)
 		epoch_cost = 0.
 		epoch_cost_sg = 0.
 		epoch_start = time.time()
-		for batch_id in range(len(tri)/batch_size):
+		for batch_id, idlist in enumerate(batches.epoch()):
 			batch_start = time.time()
 
-			idlist = id_order[batch_id*batch_size:(batch_id+1)*batch_size]
-			
+			if train_rou == 'synthetic_gradients' and pipelined:
+				# the cost of a minibatch comes out of the last stage a few minibatches later
+				in_flight.append(batch_id)
+				cost = pipeline.feed(idlist)
+				if cost is not None:
+					epoch_cost += cost
+					cost_report.log(epoch, in_flight.pop(0), cost, time.time() - batch_start)
+				continue
+
 			if train_rou == 'backprop':
 				cost = f_grad_shared(idlist)
 				min_cost = min(min_cost, cost)
@@ -257,9 +324,21 @@ if len(sys.argv) < 2 or int(sys.argv[1]) == 0:
 				epoch_cost_sg += cost_sg
 
 			epoch_cost += cost
-			cost_report.write(str(epoch) + ',' + str(batch_id) + ',' + str(cost) + ',' + str(time.time() - batch_start) + '\n')
+			cost_report.log(epoch, batch_id, cost, time.time() - batch_start)
+
+		if train_rou == 'synthetic_gradients' and pipelined:
+			# the last minibatches of the epoch
+			while len(in_flight) > 0:
+				batch_start = time.time()
+				cost = pipeline.result()
+				epoch_cost += cost
+				cost_report.log(epoch, in_flight.pop(0), cost, time.time() - batch_start)
+
+			epoch_cost_sg = pipeline.sg_costs.sum() - sg_total
+			sg_total += epoch_cost_sg
 
 		print ": Cost " + str(epoch_cost) + " : Time " + str(time.time() - epoch_start)
+		cost_report.flush()
 
 		if train_rou == 'synthetic_gradients':
 			print "SG cost : " + str(epoch_cost_sg)
@@ -267,13 +346,15 @@ if len(sys.argv) < 2 or int(sys.argv[1]) == 0:
 		# save every save_freq epochs
 		if (epoch + 1) % save_freq == 0:
 			print "Saving..."
+			if train_rou == 'synthetic_gradients' and pipelined:
+				pipeline.publish()
 
 			params = {}
 			for key, val in tparams.iteritems():
 				params[key] = val.get_value()
 
-			# numpy saving
-			np.savez('./Results/classification/' + train_rou + '/training_' + code + '_' + str(batch_size) + '_' + str(learning_rate) + '_' + str(epoch+1) + '.npz', **params)
+			# numpy saving, in the background
+			checkpoints.save('./Results/classification/' + train_rou + '/training_' + code + '_' + str(batch_size) + '_' + str(learning_rate) + '_' + str(epoch+1) + '.npz', params)
 			print "Done!"
 
 		epoch += 1
@@ -282,6 +363,11 @@ if len(sys.argv) < 2 or int(sys.argv[1]) == 0:
 		elif term_condition == 'e' and epoch >= max_epochs:
 			condition = True
 
+	cost_report.close()
+	if train_rou == 'synthetic_gradients' and pipelined:
+		# the final weights of every stage
+		pipeline.close()
+
 	# saving the final model
 	if epoch % save_freq != 0:
 		print "Saving..."
@@ -290,10 +376,12 @@ if len(sys.argv) < 2 or int(sys.argv[1]) == 0:
 		for key, val in tparams.iteritems():
 			params[key] = val.get_value()
 
-		# numpy saving
-			np.savez('./Results/classification/' + train_rou + '/training_' + code + '_' + str(batch_size) + '_' + str(learning_rate) + '_' + str(epoch) + '.npz', **params)
+		# numpy saving, in the background
+		checkpoints.save('./Results/classification/' + train_rou + '/training_' + code + '_' + str(batch_size) + '_' + str(learning_rate) + '_' + str(epoch) + '.npz', params)
 		print "Done!"
 
+	checkpoints.close()
+
 else:
 	pred = T.argmax(probs, axis=1)
 	acc = T.mean(T.eq(pred, lbl)) * 100
@@ -0,0 +1,54 @@
+import numpy as np
+
+'''
+Evaluation of a compiled per-image loss over a whole dataset in chunks of fixed size, so that
+memory stays bounded whatever the size of the dataset and the number of latent samples per image.
+'''
+
+class RunningMean():
+	'''
+	Mean and standard error of a stream of values, updated one chunk at a time.
+	Chunk statistics are merged with the pairwise update of Chan et al., in float64.
+	'''
+	def __init__(self):
+		self.count = 0
+		self.mean = 0.
+		# sum of squared deviations from the mean
+		self.m2 = 0.
+
+	def update(self, values):
+		values = np.asarray(values, dtype=np.float64).ravel()
+		n = len(values)
+		if n == 0:
+			return
+
+		mean = values.mean()
+		m2 = np.sum((values - mean) ** 2)
+		total = self.count + n
+		diff = mean - self.mean
+		self.mean += diff * n / total
+		self.m2 += m2 + diff ** 2 * self.count * n / total
+		self.count = total
+
+	def variance(self):
+		if self.count < 2:
+			return 0.
+		return self.m2 / (self.count - 1)
+
+	def stderr(self):
+		if self.count == 0:
+			return 0.
+		return np.sqrt(self.variance() / self.count)
+
+def evaluate(f, num_items, chunk_size, *inps):
+	'''
+	Calls f(ids, *inps) on consecutive chunks of at most chunk_size ids out of range(num_items),
+	f returns one value per id (such as the loss of every image, averaged over its latent samples).
+	Returns the RunningMean of all the values.
+	'''
+	stats = RunningMean()
+	for start in range(0, num_items, chunk_size):
+		ids = np.arange(start, min(start + chunk_size, num_items), dtype=np.int64)
+		stats.update(f(ids, *inps))
+
+	return stats
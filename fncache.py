@@ -0,0 +1,120 @@
+import os
+import sys
+import cPickle
+import hashlib
+import numpy as np
+import theano
+
+'''
+On-disk cache of compiled theano functions. Graph optimization and compilation dominate the startup of
+the training scripts, and they give the same result every time a configuration is repeated. The functions of
+a script are pickled together (so that state shared between them, like gradient buffers, stays shared) and
+are unpickled without being optimized again.
+
+Shared variables that the script sets itself (parameters, datasets, learning rates) are stored empty. After loading,
+the values of the script's own shared variables are moved into the matching (same name) shared variables of the
+loaded functions, which the script then uses in place of its own.
+
+The cache key includes the source of the script and of the modules it imported from its own directory, so that
+functions compiled from an older version of the code are never loaded.
+'''
+
+CACHE_DIR = os.path.join(theano.config.compiledir, 'functions')
+
+# graphs are pickled recursively, the default limit is too low for them
+RECURSION_LIMIT = 50000
+
+def source_digest():
+	'''
+	md5 of the source files of the running script and of the modules loaded from its directory
+	'''
+	main = os.path.abspath(sys.modules['__main__'].__file__)
+	directory = os.path.dirname(main)
+	files = set([main])
+	for module in sys.modules.values():
+		fname = getattr(module, '__file__', None)
+		if fname is not None and os.path.dirname(os.path.abspath(fname)) == directory:
+			files.add(os.path.abspath(fname))
+
+	digest = hashlib.md5()
+	for fname in sorted(files):
+		# compiled modules are hashed through their source
+		if fname.endswith('.pyc') or fname.endswith('.pyo'):
+			fname = fname[:-1]
+		digest.update(os.path.basename(fname))
+		with open(fname, 'rb') as f:
+			digest.update(f.read())
+	return digest.hexdigest()
+
+def cache_file(script, config):
+	'''
+	File holding the functions compiled by script for config (dict of the arguments that shape the graph)
+	'''
+	key = repr(sorted(config.items())) + theano.__version__ + theano.config.floatX + theano.config.device + str(theano.config.mode) + source_digest()
+	return os.path.join(CACHE_DIR, script + '_' + hashlib.md5(key).hexdigest() + '.pkl')
+
+def save_functions(fname, functions, shared):
+	'''
+	functions: OrderedDict from name to compiled function
+	shared: dict from name to the shared variables whose values are set by the script
+	'''
+	# arrays are swapped for empty ones while pickling, so that datasets and parameters are not written
+	values = {}
+	for name, var in shared.iteritems():
+		value = var.get_value(borrow=True)
+		if isinstance(value, np.ndarray) and value.ndim > 0:
+			values[name] = value
+			var.set_value(np.zeros([1 if b else 0 for b in var.broadcastable], dtype=value.dtype), borrow=True)
+
+	# written under a temporary name, so that concurrent runs never load a partial file
+	tmp = fname + '.' + str(os.getpid()) + '.tmp'
+	limit = sys.getrecursionlimit()
+	sys.setrecursionlimit(max(limit, RECURSION_LIMIT))
+	try:
+		if not os.path.isdir(CACHE_DIR):
+			os.makedirs(CACHE_DIR)
+
+		with open(tmp, 'wb') as f:
+			cPickle.dump(functions, f, cPickle.HIGHEST_PROTOCOL)
+		os.rename(tmp, fname)
+	except (IOError, OSError, RuntimeError, cPickle.PicklingError) as e:
+		print "Could not cache the compiled functions: " + str(e)
+		if os.path.exists(tmp):
+			os.remove(tmp)
+	finally:
+		sys.setrecursionlimit(limit)
+		for name, value in values.iteritems():
+			shared[name].set_value(value, borrow=True)
+
+def load_functions(fname, shared):
+	'''
+	Returns the functions stored in fname (None if there are none) and a dict from name to their shared
+	variables that replace the given ones (shared, dict from name to shared variable), which have their values
+	'''
+	if not os.path.exists(fname):
+		return None, None
+
+	reoptimize = theano.config.reoptimize_unpickled_function
+	theano.config.reoptimize_unpickled_function = False
+	limit = sys.getrecursionlimit()
+	sys.setrecursionlimit(max(limit, RECURSION_LIMIT))
+	try:
+		with open(fname, 'rb') as f:
+			functions = cPickle.load(f)
+	except Exception as e:
+		print "Could not load the cached functions, compiling: " + str(e)
+		return None, None
+	finally:
+		theano.config.reoptimize_unpickled_function = reoptimize
+		sys.setrecursionlimit(limit)
+
+	replaced = {}
+	for f in functions.values():
+		for var in f.get_shared():
+			if var.name in shared:
+				replaced[var.name] = var
+
+	for name, var in replaced.iteritems():
+		var.set_value(shared[name].get_value(borrow=True), borrow=True)
+
+	return functions, replaced
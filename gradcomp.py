@@ -1,14 +1,17 @@
 import sys
 
 import numpy as np
-from read_mnist import read, show
+from read_mnist import read_arrays, show
 import theano
 import theano.tensor as T
-from utils import init_weights, _concat
+from utils import init_weights, _concat, PhaseTimer
 import argparse
 
 from adam import adam
 from sgd import SGD
+from batches import BatchIterator
+from metrics import MetricsLogger
+from fncache import cache_file, save_functions, load_functions
 
 from collections import OrderedDict
 import time
@@ -46,6 +49,10 @@ parser.add_argument('-l', '--load', type=str, default=None, help='Path to weight
 # miscellaneous
 parser.add_argument('-q', '--random_seed', type=int, default=42, help='Seed to initialize random streams')
 parser.add_argument('-y', '--base_code', type=str, default='', help='Unique identifier for the files generated by the process')
+parser.add_argument('-aa', '--shared_data', type=int, default=0,
+					help='Attach to the preprocessed dataset in shared memory, publishing it if needed (1), or keep a private copy (0)')
+parser.add_argument('-ab', '--compile_cache', type=int, default=0,
+					help='Reuse the compiled functions of an earlier run with the same graph, storing them after compiling in <compiledir>/functions (1) or always compile (0)')
 args = parser.parse_args()
 
 # random seed and initialization of stream
@@ -57,16 +64,6 @@ else:
 code_name = args.base_code + '_' + str(args.repeat)
 # ---------------------------------------------------------------------------------------------------------------------------------------------------------
 
-# converts images into binary images for simplicity
-def binarize_img(img):
-	return np.asarray(img >= 100, dtype=np.int8)
-
-# split into two images
-def split_img(img):
-	# images are flattened into a vector: just need to split into half
-	veclen = len(img)
-	return (img[:veclen/2], img[veclen/2:])
-
 def param_init_fflayer(params, prefix, nin, nout, zero_init=False, batchnorm=False):
 	'''
 	Initializes weights for a feedforward layer
@@ -200,16 +197,13 @@ def synth_grad(tparams, prefix, inp, mode='Train'):
 			return T.dot(inp, tparams[_concat(prefix, 'W')]) + tparams[_concat(prefix, 'b')] + fflayer(tparams, outh + outi, _concat(prefix, 'o'), batchnorm=bn_last, nonlin=None)
 # ---------------------------------------------------------------------------------------------------------------------------------------------------------
 
-print "Creating partial images"
-# collect training data and converts image into binary and does row major flattening
-trc = np.asarray([binarize_img(img).flatten() for lbl, img in read(dataset='training', path ='MNIST/')], dtype=np.float32)
-
-# collect test data and converts image into binary and does row major flattening
-tec = np.asarray([binarize_img(img).flatten() for lbl, img in read(dataset='testing', path = 'MNIST/')], dtype=np.float32)
+# time spent in each phase before training starts
+startup = PhaseTimer()
 
-# split images
-trp = [split_img(img) for img in trc]
-tep = [split_img(img) for img in tec]
+print "Creating partial images"
+# binarized training images, flattened in row major order and split into top and bottom halves
+top, bot = read_arrays(dataset='training', path='MNIST/', binarize=100, split=True, cache=True, shared=args.shared_data)
+startup.mark('data load')
 
 print "Initializing parameters"
 # parameter initializations
@@ -255,23 +249,23 @@ if args.load is not None:
 tparams = OrderedDict()
 for key, val in params.iteritems():
 	tparams[key] = theano.shared(val, name=key)
+startup.mark('parameter init')
 # ---------------------------------------------------------------------------------------------------------------------------------------------------------
 
 # Training Graph
 print "Constructing graph for training"
-# create shared variables for dataset for easier access
-top = np.asarray([splitimg[0] for splitimg in trp], dtype=np.float32)
-bot = np.asarray([splitimg[1] for splitimg in trp], dtype=np.float32)
-
-train = theano.shared(top, name='train')
-train_gt = theano.shared(bot, name='train_gt')
+# create shared variables for dataset for easier access, borrowed so that the arrays are not copied again
+train = theano.shared(top, name='train', borrow=True)
+train_gt = theano.shared(bot, name='train_gt', borrow=True)
 
 # pass a batch of indices while training
 img_ids = T.vector('ids', dtype='int64')
 img = train[img_ids, :]
+gt = train_gt[img_ids, :]
+
+# rows of the image and target for every latent sample, only the synthetic gradient subnetwork takes them
 img_r = T.extra_ops.repeat(img, args.repeat, axis=0)
-gt_unrepeated = train_gt[img_ids, :]
-gt = T.extra_ops.repeat(gt_unrepeated, args.repeat, axis=0)
+gt_r = T.extra_ops.repeat(gt, args.repeat, axis=0)
 
 # inputs for synthetic gradient networks, provide the top half of the image as well
 target_gradients = T.matrix('tg', dtype='float32')
@@ -288,6 +282,7 @@ if args.bn_type == 0:
 else:
 	out3 = fflayer(tparams, out2, _concat(ff_e, 'bern'), nonlin=None, batchnorm=None)
 
+# one row per latent sample, the estimators below are compared on the gradients wrt every sample
 out3_r = T.extra_ops.repeat(out3, args.repeat, axis=0)
 latent_probs_r = T.nnet.nnet.sigmoid(out3_r)
 
@@ -307,8 +302,11 @@ else:
 	probs = fflayer(tparams, outh, _concat(ff_d, 'o'), nonlin='sigmoid', batchnorm=None)
 # ---------------------------------------------------------------------------------------------------------------------------------------------------------
 
+startup.mark('graph build')
+
 # having large number of latent samples is necessary: multi-sample REINFORCE essentially gives the true gradients at the tradeoff of speed.
-reconstruction_loss = T.nnet.binary_crossentropy(probs, gt).mean(axis=1)
+# one row per image and one column per latent sample, the target is broadcast over the samples
+reconstruction_loss = T.nnet.binary_crossentropy(probs.reshape((args.batch_size, args.repeat, 14*28)), gt.dimshuffle(0, 'x', 1)).mean(axis=2)
 
 # separate parameters for encoder and decoder
 param_dec = [val for key, val in tparams.iteritems() if ('ff_dec' in key) and ('rm' not in key and 'rv' not in key)]
@@ -319,8 +317,9 @@ cost_decoder = T.mean(reconstruction_loss)
 grads_decoder = T.grad(cost_decoder, wrt=param_dec)
 
 # REINFORCE gradients: conditional mean is subtracted from the reconstruction loss to lower variance further
-baseline = T.extra_ops.repeat(fflayer(tparams, T.concatenate([img, train_gt[img_ids, :]], axis=1), 'loss_pred', nonlin='relu'), args.repeat, axis=0)
-cost_encoder = T.mean((reconstruction_loss - baseline.T) * T.switch(latent_samples, T.log(latent_probs_r), T.log(1. - latent_probs_r)).sum(axis=1))
+baseline = T.addbroadcast(fflayer(tparams, T.concatenate([img, gt], axis=1), 'loss_pred', nonlin='relu'), 1)
+log_probs = T.switch(latent_samples, T.log(latent_probs_r), T.log(1. - latent_probs_r)).sum(axis=1).reshape((args.batch_size, args.repeat))
+cost_encoder = T.mean((reconstruction_loss - baseline) * log_probs)
 consider_constant = [reconstruction_loss, latent_samples, baseline]
 grads_encoder = T.grad(cost_encoder, wrt=param_enc + [out3, out3_r], consider_constant=consider_constant)
 
@@ -331,54 +330,59 @@ reinforce_1 = args.repeat * grads_encoder[-1] # * args.batch_size
 grads_encoder = grads_encoder[:-2]
 
 # optimizing the loss predictor for conditional mean baseline
-cost_pred = 0.5 * ((reconstruction_loss - baseline.T) ** 2).sum()
+cost_pred = 0.5 * ((reconstruction_loss - baseline) ** 2).sum()
 params_loss_predictor = [val for key, val in tparams.iteritems() if 'loss_pred' in key]
 grads_plp = T.grad(cost_pred, wrt=params_loss_predictor, consider_constant=[reconstruction_loss])
 
 # computation of different gradients, bias and variances: we have already computed true gradient example wise above
-temp = T.extra_ops.repeat(true_gradient, args.repeat, axis=0)
+# the per sample gradients are viewed in (batch, repeat, latent) layout, the per image ones are broadcast over the samples
+true_gradient_r = true_gradient.dimshuffle(0, 'x', 1)
+reinforce_1_r = reinforce_1.reshape((args.batch_size, args.repeat, latent_dim))
 
 # bias-variance of 1-sample reinforce: expected value for the gradient is the true gradient itself: bias should approximately be zero
-bias2_reinforce = ((reinforce_1.reshape((args.batch_size, args.repeat, latent_dim)).sum(axis=1) / args.repeat - true_gradient) ** 2).sum() # / args.batch_size
-var_reinforce = ((reinforce_1 - temp) ** 2).sum() / (args.repeat) # * args.batch_size)
-r_samedir = T.cast((reinforce_1 * temp).sum(axis=1) > 0, 'float32').sum() / (args.batch_size * args.repeat)
+bias2_reinforce = ((reinforce_1_r.sum(axis=1) / args.repeat - true_gradient) ** 2).sum() # / args.batch_size
+var_reinforce = ((reinforce_1_r - true_gradient_r) ** 2).sum() / (args.repeat) # * args.batch_size)
+r_samedir = T.cast((reinforce_1_r * true_gradient_r).sum(axis=2) > 0, 'float32').sum() / (args.batch_size * args.repeat)
 
 # bias-variance decomposition of straight through estimator
 st = args.repeat * T.grad(cost_decoder, wrt=out3_r, consider_constant=[dummy]) # * args.batch_size 
-ez_st = st.reshape((args.batch_size, args.repeat, latent_dim)).sum(axis=1) / args.repeat
+st_r = st.reshape((args.batch_size, args.repeat, latent_dim))
+ez_st = st_r.sum(axis=1) / args.repeat
 ez_st_norm = (ez_st ** 2).sum() # / args.batch_size
 bias2_st = ((ez_st - true_gradient) ** 2).sum() # / args.batch_size
-var_st = ((st - T.extra_ops.repeat(ez_st, args.repeat, axis=0)) ** 2).sum() / (args.repeat) # * args.batch_size)
-st_samedir = T.cast((st * temp).sum(axis=1) > 0, 'float32').sum() / (args.batch_size * args.repeat)
+var_st = ((st_r - ez_st.dimshuffle(0, 'x', 1)) ** 2).sum() / (args.repeat) # * args.batch_size)
+st_samedir = T.cast((st_r * true_gradient_r).sum(axis=2) > 0, 'float32').sum() / (args.batch_size * args.repeat)
 
 # bias-variance decomposition of synthetic gradients
 param_sg = [val for key, val in tparams.iteritems() if ('sg' in key) and ('rm' not in key and 'rv' not in key)]
 gradz = args.repeat * T.grad(cost_decoder, wrt=latent_samples) # * args.batch_size
 
 # the multiplications by repeat/batch_size are not carried out because synthetic gradients would produce the same gradients even if one sample/example was given.
-var_list = [img_r, gt, latent_probs_r, gradz, latent_samples]
-sg_r = synth_grad(tparams, _concat(sg, 'r'), T.concatenate(var_list, axis=1), mode='test')
-ez_sg = sg_r.reshape((args.batch_size, args.repeat, latent_dim)).sum(axis=1) / args.repeat
+var_list = [img_r, gt_r, latent_probs_r, gradz, latent_samples]
+sg_r = synth_grad(tparams, _concat(sg, 'r'), T.concatenate(var_list, axis=1), mode='test').reshape((args.batch_size, args.repeat, latent_dim))
+ez_sg = sg_r.sum(axis=1) / args.repeat
 ez_sg_norm = (ez_sg ** 2).sum() # / args.batch_size
 
 bias2_sg = ((ez_sg - true_gradient) ** 2).sum() # / args.batch_size
-var_sg = ((sg_r - T.extra_ops.repeat(ez_sg, args.repeat, axis=0)) ** 2).sum() / (args.repeat) # * args.batch_size)
-sg_samedir = T.cast((sg_r * temp).sum(axis=1) > 0, 'float32').sum() / (args.batch_size * args.repeat)
+var_sg = ((sg_r - ez_sg.dimshuffle(0, 'x', 1)) ** 2).sum() / (args.repeat) # * args.batch_size)
+sg_samedir = T.cast((sg_r * true_gradient_r).sum(axis=2) > 0, 'float32').sum() / (args.batch_size * args.repeat)
 grads_encoder_sg = T.grad(None, wrt=param_enc, known_grads={out3:ez_sg})
 
 # optimizing the synthetic gradient subnetwork
-loss_sg = T.mean((target_gradients - synth_grad(tparams, _concat(sg, 'r'), T.concatenate([img_r, gt, activation, latent_gradients, samples], axis=1)).reshape((args.batch_size, args.repeat, latent_dim)).sum(axis=1) / args.repeat) ** 2)
+loss_sg = T.mean((target_gradients - synth_grad(tparams, _concat(sg, 'r'), T.concatenate([img_r, gt_r, activation, latent_gradients, samples], axis=1)).reshape((args.batch_size, args.repeat, latent_dim)).sum(axis=1) / args.repeat) ** 2)
 grads_sg = T.grad(loss_sg, wrt=param_sg)
 
 # final gradients for the main network
 grads = grads_encoder + grads_plp + grads_decoder
 # ------------------------------------------------------------------ General training routine ----------------------------------------------------------------------------------
 
+startup.mark('gradients')
+
 # learning rate
 lr = T.scalar('lr', dtype='float32')
 
 inps_net = [img_ids]
-outs = [cost_decoder, reinforce_1.reshape((args.batch_size, args.repeat, latent_dim))[:,0,:], latent_probs_r, gradz, latent_samples, true_gradient_norm, bias2_reinforce, var_reinforce, r_samedir, ez_st_norm, bias2_st, var_st, st_samedir, ez_sg_norm, bias2_sg, var_sg, sg_samedir]
+outs = [cost_decoder, reinforce_1_r[:,0,:], latent_probs_r, gradz, latent_samples, true_gradient_norm, bias2_reinforce, var_reinforce, r_samedir, ez_st_norm, bias2_st, var_st, st_samedir, ez_sg_norm, bias2_sg, var_sg, sg_samedir]
 inps_sg = inps_net + [target_gradients, activation, latent_gradients, samples]
 tparams_net = OrderedDict()
 tparams_sg = OrderedDict()
@@ -394,16 +398,52 @@ for key, val in tparams.iteritems():
 		tparams_net[key] = val
 
 print "Setting up optimizers"
-f_grad_shared, f_update = adam(lr, tparams_net, grads, inps_net, outs)
-# f_grad_shared_sg, f_update_sg = adam(lr, tparams_sg, grads_sg, inps_sg, loss_sg)
-
-# sgd with momentum updates
 sgd = SGD(lr=args.learning_rate)
-f_update_sg = theano.function(inps_sg, loss_sg, updates=sgd.get_grad_updates(loss_sg, param_sg), on_unused_input='ignore', profile=False)
+
+# shared variables set by this script, cached functions come with their own copies which take these values
+script_shared = OrderedDict((key, val) for key, val in tparams.iteritems() if isinstance(val, theano.compile.SharedVariable))
+script_shared['train'] = train
+script_shared['train_gt'] = train_gt
+script_shared['lr'] = sgd.lr
+script_shared['momentum'] = sgd.momentum
+
+functions = None
+if args.compile_cache:
+	# arguments that leave the compiled graph unchanged
+	run_args = ['learning_rate', 'term_condition', 'num_epochs', 'min_cost', 'base_code', 'load', 'shared_data', 'compile_cache']
+	functions_file = cache_file('gradcomp', dict((k, v) for k, v in vars(args).iteritems() if k not in run_args))
+	functions, replaced = load_functions(functions_file, script_shared)
+
+if functions is None:
+	functions = OrderedDict()
+	functions['f_grad_shared'], functions['f_update'] = adam(lr, tparams_net, grads, inps_net, outs)
+	# f_grad_shared_sg, f_update_sg = adam(lr, tparams_sg, grads_sg, inps_sg, loss_sg)
+
+	# sgd with momentum updates
+	functions['f_update_sg'] = theano.function(inps_sg, loss_sg, updates=sgd.get_grad_updates(loss_sg, param_sg), on_unused_input='ignore', profile=False)
+
+	if args.compile_cache:
+		save_functions(functions_file, functions, script_shared)
+else:
+	print "Loaded the compiled functions from " + functions_file
+	for key in tparams:
+		if key in replaced:
+			tparams[key] = replaced[key]
+	sgd.lr = replaced.get('lr', sgd.lr)
+	sgd.momentum = replaced.get('momentum', sgd.momentum)
+
+f_grad_shared = functions['f_grad_shared']
+f_update = functions['f_update']
+f_update_sg = functions['f_update_sg']
+startup.mark('compile')
+startup.report()
 
 print "Training"
-cost_report = open('./Results/disc/SF/gradcomp_' + code_name + '_' + str(args.batch_size) + '_' + str(args.learning_rate) + '.txt', 'w')
-id_order = range(len(trc))
+# shuffled minibatches are prepared by a background thread while the compiled functions run
+batches = BatchIterator(len(top), args.batch_size)
+# binary records, buffered in memory and written by a background thread
+columns = ['epoch', 'batch', 'cost', 'true_grad_norm', 'bias2_reinforce', 'var_reinforce', 'samedir_reinforce', 'norm_st', 'bias2_st', 'var_st', 'samedir_st', 'norm_sg', 'bias2_sg', 'var_sg', 'samedir_sg', 'time']
+cost_report = MetricsLogger('./Results/disc/SF/gradcomp_' + code_name + '_' + str(args.batch_size) + '_' + str(args.learning_rate) + '.bin', columns, batch_size=args.batch_size, steps_per_epoch=batches.num_batches)
 
 iters = 0
 min_cost = 100000.0
@@ -412,16 +452,13 @@ condition = False
 
 while condition == False:
 	print "Epoch " + str(epoch + 1),
-	np.random.shuffle(id_order)
 	epoch_cost = 0.
 	epoch_diff = 0.
 	epoch_start = time.time()
 	
-	for batch_id in range(len(trc)/args.batch_size):
+	for batch_id, idlist in enumerate(batches.epoch()):
 		batch_start = time.time()
 
-		idlist = id_order[batch_id*args.batch_size:(batch_id+1)*args.batch_size]
-		
 		cost, t, lpc, gradz, ls, tgn, br, vr, sr, sn, bs, vs, ss, sgn, bsg, vsg, ssg = f_grad_shared(idlist)
 		min_cost = min(min_cost, cost)
 		f_update(args.learning_rate)
@@ -431,12 +468,15 @@ while condition == False:
 		
 		epoch_cost += cost
 		# epoch, batch id, main networks cost, norm of true gradient, bias-reinforce, variance-reinforce, reinforce half-space correlation, straight-through squared norm, bias-straight through, variance-straight through, reinforce half-space correlation, synthetic gradient squared norm, bias-synthetic gradient, variance synthetic gradient, half-space correlation, time of computation
-		cost_report.write(str(epoch) + ',' + str(batch_id) + ',' + str(cost)  + ',' + str(tgn) + ',' + str(br) + ',' + str(vr) + ',' + str(sr) + ',' + str(sn) + ',' + str(bs) + ',' + str(vs) + ',' + str(ss) + ',' + str(sgn) + ',' + str(bsg) + ',' + str(vsg) + ',' + str(ssg) + ',' + str(time.time() - batch_start) + '\n')
+		cost_report.log(epoch, batch_id, cost, tgn, br, vr, sr, sn, bs, vs, ss, sgn, bsg, vsg, ssg, time.time() - batch_start)
 
 	print ": Cost " + str(epoch_cost) + " : Time " + str(time.time() - epoch_start)
+	cost_report.flush()
 
 	epoch += 1
 	if args.term_condition == 'mincost' and min_cost < args.min_cost:
 		condition = True
 	elif args.term_condition == 'epochs' and epoch >= args.num_epochs:
 		condition = True
+
+cost_report.close()
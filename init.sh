@@ -7,6 +7,7 @@ wget "http://yann.lecun.com/exdb/mnist/train-labels-idx1-ubyte.gz"
 wget "http://yann.lecun.com/exdb/mnist/t10k-images-idx3-ubyte.gz"
 wget "http://yann.lecun.com/exdb/mnist/t10k-labels-idx1-ubyte.gz"
 
+# read_mnist also reads the .gz archives directly, decompressing is only needed for memory mapped reads
 gunzip train-images-idx3-ubyte.gz
 gunzip train-labels-idx1-ubyte.gz
 gunzip t10k-images-idx3-ubyte.gz
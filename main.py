@@ -1,16 +1,25 @@
 import sys
+import os
 
 import numpy as np
-from read_mnist import read, show
+from read_mnist import read_arrays, read_chunks, show
 import theano
 import theano.tensor as T
-from utils import init_weights, _concat
-from adam import adam
+from utils import init_weights, _concat, PhaseTimer
+from adam import adam, adam_step, adam_multistep
+from batches import BatchIterator, ShuffleBuffer
+from metrics import MetricsLogger
+from checkpoint import CheckpointWriter
+from trainstate import state_variables, capture, load, restore, StopRequest
+from fncache import cache_file, save_functions, load_functions
+from evaluation import evaluate
+from parallel import GradientAverager, AsyncParameters, decorrelate
 from theano.compile.nanguardmode import NanGuardMode
 import argparse
 
 from collections import OrderedDict
 import time
+import itertools
 
 '''
 A model to complete the images from MNIST, when only the top half is given. The top half is encoded into a latent distribution, 
@@ -71,6 +80,33 @@ parser.add_argument('-f', '--base_code', type=str, default='',
 parser.add_argument('-p', '--clip_probs', type=int, default=0,
 					help='clip latent probabilities (1) or not (0), useful for testing training under NaNs')
 parser.add_argument('-q', '--random_seed', type=int, default=42, help='Seed to initialize random streams')
+parser.add_argument('-ac', '--shared_data', type=int, default=0,
+					help='Attach to the preprocessed dataset in shared memory, publishing it if needed (1), or keep a private copy (0)')
+parser.add_argument('-ad', '--data_path', type=str, default='MNIST/', help='Directory with the IDX files of the dataset')
+parser.add_argument('-ae', '--stream_buffer', type=int, default=0,
+					help='Stream the training set from disk through a shuffle buffer of this many images, for datasets larger than memory (0 loads it into memory)')
+parser.add_argument('-af', '--device_perm', type=int, default=0,
+					help='Keep the epoch permutation in a shared variable so that each step only takes the batch number (1) or pass the image ids every step (0)')
+parser.add_argument('-ag', '--fused_step', type=int, default=0,
+					help='Compute the gradients and apply the Adam update in a single compiled call (1) or in two calls through gradient buffers (0)')
+parser.add_argument('-ah', '--steps_per_call', type=int, default=1,
+					help='Number of consecutive minibatches run by a single compiled call, values above 1 imply a fused step')
+parser.add_argument('-ai', '--resume', type=int, default=0,
+					help='Continue from the training state saved for this configuration, if there is one (1) or start from scratch (0)')
+parser.add_argument('-aj', '--compile_cache', type=int, default=0,
+					help='Reuse the compiled training functions of an earlier run with the same graph, storing them after compiling in <compiledir>/functions (1) or always compile (0)')
+parser.add_argument('-ak', '--val_freq', type=int, default=0,
+					help='Evaluate the test set with the current weights every this many epochs while training, 0 disables it')
+parser.add_argument('-al', '--num_samples', type=int, default=1,
+					help='Number of latent samples per test image, the loss of an image is averaged over them')
+parser.add_argument('-am', '--eval_chunk', type=int, default=1000,
+					help='Number of test images evaluated per call')
+parser.add_argument('-an', '--workers', type=int, default=1,
+					help='Data parallel worker processes, each computes the gradients of batch_size images of a global batch of workers * batch_size (limit the BLAS threads of each, e.g. OMP_NUM_THREADS)')
+parser.add_argument('-ao', '--hogwild', type=int, default=0,
+					help='With several workers, train asynchronously on shared parameters, each worker on its own part of the training set (1) or average the gradients of every step (0)')
+parser.add_argument('-ap', '--max_staleness', type=int, default=-1,
+					help='Asynchronous workers wait while they are more than this many steps ahead of the slowest one, -1 never waits')
 
 args = parser.parse_args()
 
@@ -92,16 +128,6 @@ init_rate = args.learning_rate
 temperature_init = 1.0
 # ---------------------------------------------------------------------------------------------------------------------------------------------------------
 
-# converts images into binary images for simplicity
-def binarize_img(img):
-	return np.asarray(img >= 100, dtype=np.int8)
-
-# split into two images
-def split_img(img):
-	# images are flattened into a vector: just need to split into half
-	veclen = len(img)
-	return (img[:veclen/2], img[veclen/2:])
-
 def param_init_fflayer(params, prefix, nin, nout, zero_init=False, batchnorm=False, skip_running_vars=False):
 	'''
 	Initializes weights for a feedforward layer
@@ -185,18 +211,58 @@ def fflayer(tparams, state_below, prefix, nonlin='tanh', batchnorm=None, dropout
 		return T.nnet.nnet.softplus(preact)
 	elif nonlin == 'relu':
 		return T.nnet.nnet.relu(preact)
-# ---------------------------------------------------------------------------------------------------------------------------------------------------------
 
-print "Creating partial images"
-# collect training data and converts image into binary and does row major flattening
-trc = np.asarray([binarize_img(img).flatten() for lbl, img in read(dataset='training', path ='MNIST/')], dtype=np.float32)
+def test_losses(tparams, img, gt, num_samples=1):
+	'''
+	Test mode loss of every image (batchnorm with running averages), averaged over num_samples latent samples.
+	The encoder runs once, the samples of all images are drawn and decoded in a single batch of num_samples * len(img) rows.
+	'''
+	global srng, args
+
+	out1 = fflayer(tparams, img, _concat(ff_e, 'i'), batchnorm='test')
+	out2 = fflayer(tparams, out1, _concat(ff_e,'h'), batchnorm='test')
 
-# collect test data and converts image into binary and does row major flattening
-tec = np.asarray([binarize_img(img).flatten() for lbl, img in read(dataset='testing', path = 'MNIST/')], dtype=np.float32)
+	# latent samples are drawn with shape (num_samples, images, latent_dim)
+	if args.latent_type == 'cont':
+		mu = fflayer(tparams, out2, _concat(ff_e, 'mu'), nonlin=None)
+		sd = fflayer(tparams, out2, _concat(ff_e, 'sd'), nonlin='softplus')
+		shape = (num_samples, mu.shape[0], mu.shape[1])
+		latent_samples = mu.dimshuffle('x', 0, 1) + sd.dimshuffle('x', 0, 1) * srng.normal(shape)
 
-# split images
-trp = [split_img(img) for img in trc]
-tep = [split_img(img) for img in tec]
+	elif args.latent_type == 'disc':
+		if args.bn_type == 0:
+			latent_probs = fflayer(tparams, out2, _concat(ff_e, 'bern'), nonlin='sigmoid', batchnorm='test')
+		else:
+			latent_probs = fflayer(tparams, out2, _concat(ff_e, 'bern'), nonlin='sigmoid', batchnorm=None)
+		shape = (num_samples, latent_probs.shape[0], latent_probs.shape[1])
+
+		if args.estimator == 'PD':
+			# gumbel-softmax at the temperature used in test mode
+			prob_vector = T.stack([1. - latent_probs, latent_probs]).dimshuffle(0, 'x', 1, 2)
+			gumbel_samples = -T.log(-T.log(srng.uniform((2,) + shape, low=0.0, high=1.0, dtype='float32') + delta) + delta)
+			latent_samples_unnormalized = (T.log(prob_vector + delta) + gumbel_samples) / 0.5
+			e_x = T.exp(latent_samples_unnormalized - latent_samples_unnormalized.max(axis=0, keepdims=True))
+			latent_samples = (e_x / e_x.sum(axis=0, keepdims=True))[1]
+			if args.sample_style == 1:
+				latent_samples = latent_samples + (latent_samples > 0.5 - latent_samples)
+		else:
+			if args.clip_probs:
+				latent_probs = T.clip(latent_probs, 1e-7, 1-1e-7)
+			latent_samples = srng.binomial(size=shape, n=1, p=latent_probs.dimshuffle('x', 0, 1), dtype=theano.config.floatX)
+
+	outz = fflayer(tparams, latent_samples.reshape((shape[0] * shape[1], shape[2])), _concat(ff_d, 'n'))
+	outh = fflayer(tparams, outz, _concat(ff_d, 'h'), batchnorm='test')
+	if args.bn_type == 0:
+		probs = fflayer(tparams, outh, _concat(ff_d, 'o'), nonlin='sigmoid', batchnorm='test')
+	else:
+		probs = fflayer(tparams, outh, _concat(ff_d, 'o'), nonlin='sigmoid', batchnorm=None)
+
+	losses = T.nnet.binary_crossentropy(probs.reshape((shape[0], shape[1], probs.shape[1])), gt.dimshuffle('x', 0, 1))
+	return losses.mean(axis=2).mean(axis=0)
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------
+
+# time spent in each phase before training starts
+startup = PhaseTimer()
 
 print "Initializing parameters"
 # parameter initializations
@@ -247,34 +313,58 @@ if args.load is not None:
 tparams = OrderedDict()
 for key, val in params.iteritems():
 	tparams[key] = theano.shared(val, name=key)
+startup.mark('parameter init')
 # ---------------------------------------------------------------------------------------------------------------------------------------------------------
 
 # Training graph
 if args.mode == 'train':
-	print "Constructing graph for training"
-	# create shared variables for dataset for easier access
-	top = np.asarray([splitimg[0] for splitimg in trp], dtype=np.float32)
-	bot = np.asarray([splitimg[1] for splitimg in trp], dtype=np.float32)
-	
-	train = theano.shared(top, name='train')
-	train_gt = theano.shared(bot, name='train_gt')
+	if args.stream_buffer > 0:
+		print "Constructing graph for training"
+		# the dataset is never materialized: binarized top and bottom halves are read in chunks and passed as batches
+		img = T.matrix('img', dtype='float32')
+		gt_unrepeated = T.matrix('gt', dtype='float32')
+		inps_data = [img, gt_unrepeated]
 
-	# pass a batch of indices while training
-	img_ids = T.vector('ids', dtype='int64')
-	img = train[img_ids, :]
-	gt = train_gt[img_ids, :]
-	if args.estimator == 'SF' or args.estimator == 'ST':
-		gt = T.extra_ops.repeat(gt, args.repeat, axis=0)
+	else:
+		print "Creating partial images"
+		# binarized training images, flattened in row major order and split into top and bottom halves
+		top, bot = read_arrays(dataset='training', path=args.data_path, binarize=100, split=True, cache=True, shared=args.shared_data)
+		startup.mark('data load')
+
+		print "Constructing graph for training"
+		# create shared variables for dataset for easier access, borrowed so that the arrays are not copied again
+		train = theano.shared(top, name='train', borrow=True)
+		train_gt = theano.shared(bot, name='train_gt', borrow=True)
+
+		# pass a batch of indices while training
+		if args.device_perm:
+			# the permutation is uploaded once per epoch and the batch is sliced out of it inside the graph
+			perm = theano.shared(np.arange(len(top), dtype=np.int64), name='perm')
+			batch_num = T.scalar('batch', dtype='int64')
+			img_ids = perm[batch_num * args.batch_size:(batch_num + 1) * args.batch_size]
+			inps_data = [batch_num]
+		else:
+			img_ids = T.vector('ids', dtype='int64')
+			inps_data = [img_ids]
+
+		img = train[img_ids, :]
+		gt_unrepeated = train_gt[img_ids, :]
+
+	# the targets are broadcast over the latent samples of an image, they are not repeated
+	gt = gt_unrepeated
 
 # Test graph
 else:
+	print "Creating partial images"
+	# binarized test images, flattened in row major order and split into top and bottom halves
+	# read from the bit-packed cache
+	top, bot = read_arrays(dataset='testing', path=args.data_path, binarize=100, split=True, cache=True, shared=args.shared_data)
+	startup.mark('data load')
+
 	print "Constructing the test graph"
-	# create shared variables for dataset for easier access
-	top = np.asarray([splitimg[0] for splitimg in tep], dtype=np.float32)
-	bot = np.asarray([splitimg[1] for splitimg in tep], dtype=np.float32)
-	
-	test = theano.shared(top, name='train')
-	test_gt = theano.shared(bot, name='train_gt')
+	# create shared variables for dataset for easier access, borrowed so that the arrays are not copied again
+	test = theano.shared(top, name='train', borrow=True)
+	test_gt = theano.shared(bot, name='train_gt', borrow=True)
 
 	# image ids
 	img_ids = T.vector('ids', dtype='int64')
@@ -286,14 +376,21 @@ else:
 out1 = fflayer(tparams, img, _concat(ff_e, 'i'), batchnorm=args.mode)
 out2 = fflayer(tparams, out1, _concat(ff_e,'h'), batchnorm=args.mode)
 
+# latent samples per image: REINFORCE and ST draw args.repeat of them, in (batch, repeat, latent) layout in latent_samples_r.
+# Only the samples and the decoder activations grow with the repeats, the per image terms are broadcast over that axis.
+num_rep = args.repeat if args.estimator == 'SF' or args.estimator == 'ST' else 1
+
 # latent parameters
 if args.latent_type == 'cont':
 	mu = fflayer(tparams, out2, _concat(ff_e, 'mu'), nonlin=None)
 	sd = fflayer(tparams, out2, _concat(ff_e, 'sd'), nonlin='softplus')
+	mu_r = mu.dimshuffle(0, 'x', 1)
+	sd_r = sd.dimshuffle(0, 'x', 1)
 
 	# sampling from zero mean normal distribution
-	eps = srng.normal(mu.shape)
-	latent_samples = mu + sd * eps
+	eps = srng.normal((mu.shape[0], num_rep, mu.shape[1]))
+	latent_samples_r = mu_r + sd_r * eps
+	latent_samples = latent_samples_r.reshape((mu.shape[0] * num_rep, mu.shape[1]))
 
 elif args.latent_type == 'disc':
 	if args.bn_type == 0:
@@ -304,12 +401,13 @@ elif args.latent_type == 'disc':
 	if args.estimator == 'SF':
 		# clipped for stability of gradients
 		if args.clip_probs:
-			latent_probs_r = T.clip(T.extra_ops.repeat(latent_probs, args.repeat, axis=0), 1e-7, 1-1e-7)
+			latent_probs_r = T.clip(latent_probs, 1e-7, 1-1e-7).dimshuffle(0, 'x', 1)
 		else:
-			latent_probs_r = T.extra_ops.repeat(latent_probs, args.repeat, axis=0)
+			latent_probs_r = latent_probs.dimshuffle(0, 'x', 1)
 
 		# sample a bernoulli distribution, which a binomial of 1 iteration
-		latent_samples = srng.binomial(size=latent_probs_r.shape, n=1, p=latent_probs_r, dtype=theano.config.floatX)
+		latent_samples_r = srng.binomial(size=(latent_probs.shape[0], num_rep, latent_probs.shape[1]), n=1, p=latent_probs_r, dtype=theano.config.floatX)
+		latent_samples = latent_samples_r.reshape((latent_probs.shape[0] * num_rep, latent_probs.shape[1]))
 	
 	elif args.estimator == 'PD':
 		# sample a gumbel-softmax distribution
@@ -332,14 +430,15 @@ elif args.latent_type == 'disc':
 	
 	# straight through estimator
 	elif args.estimator == 'ST':
-		latent_probs = T.extra_ops.repeat(latent_probs, args.repeat, axis=0)
+		latent_probs_r = latent_probs.dimshuffle(0, 'x', 1)
 
 		# sample a bernoulli distribution, which a binomial of 1 iteration
-		latent_samples_uncorrected = srng.binomial(size=latent_probs.shape, n=1, p=latent_probs, dtype=theano.config.floatX)
+		latent_samples_uncorrected = srng.binomial(size=(latent_probs.shape[0], num_rep, latent_probs.shape[1]), n=1, p=latent_probs_r, dtype=theano.config.floatX)
 		
 		# for stop gradients trick
-		dummy = latent_samples_uncorrected - latent_probs
-		latent_samples = latent_probs + dummy
+		dummy = latent_samples_uncorrected - latent_probs_r
+		latent_samples_r = latent_probs_r + dummy
+		latent_samples = latent_samples_r.reshape((latent_probs.shape[0] * num_rep, latent_probs.shape[1]))
 
 # decoding
 outz = fflayer(tparams, latent_samples, _concat(ff_d, 'n'))
@@ -352,8 +451,10 @@ else:
 
 # Training
 if args.mode == 'train':
+	startup.mark('graph build')
 
-	reconstruction_loss = T.nnet.binary_crossentropy(probs, gt).mean(axis=1)
+	# one row per image and one column per latent sample
+	reconstruction_loss = T.nnet.binary_crossentropy(probs.reshape((gt.shape[0], num_rep, gt.shape[1])), gt.dimshuffle(0, 'x', 1)).mean(axis=2)
 
 	# Uses the reparametrization trick
 	if args.estimator == 'PD':
@@ -392,26 +493,28 @@ if args.mode == 'train':
 
 		print "Computing gradients wrt to encoder parameters"
 		if args.latent_type == 'cont':
-			cost_encoder = T.mean(reconstruction_loss * (-0.5 * T.log(abs(sd) + delta).sum(axis=1) - 0.5 * (((latent_samples - mu)/(sd + delta)) ** 2).sum(axis=1)))
+			cost_encoder = T.mean(reconstruction_loss * (-0.5 * T.log(abs(sd) + delta).sum(axis=1).dimshuffle(0, 'x') - 0.5 * (((latent_samples_r - mu_r)/(sd_r + delta)) ** 2).sum(axis=2)))
 			
 		elif args.latent_type =='disc':
 			# arguments to be considered constant when computing gradients
-			consider_constant = [reconstruction_loss, latent_samples]
+			consider_constant = [reconstruction_loss, latent_samples_r]
+			# log probabilities of the samples, the logs are only taken once per image and latent unit
+			log_probs = T.switch(latent_samples_r, T.log(latent_probs_r), T.log(1. - latent_probs_r)).sum(axis=2)
 
 			if args.var_red is None:
-				cost_encoder = T.mean(reconstruction_loss * T.switch(latent_samples, T.log(latent_probs_r), T.log(1. - latent_probs_r)).sum(axis=1))
+				cost_encoder = T.mean(reconstruction_loss * log_probs)
 				
 			elif args.var_red == 'mr':
 				# unconditional mean is subtracted from the reconstruction loss, to yield a relatively lower variance unbiased REINFORCE estimator
-				cost_encoder = T.mean((reconstruction_loss - T.mean(reconstruction_loss)) * T.switch(latent_samples, T.log(latent_probs_r), T.log(1. - latent_probs_r)).sum(axis=1))
+				cost_encoder = T.mean((reconstruction_loss - T.mean(reconstruction_loss)) * log_probs)
 			
 			elif args.var_red == 'cmr':
-				# conditional mean is subtracted from the reconstruction loss to lower variance further
-				baseline = T.extra_ops.repeat(fflayer(tparams, T.concatenate([img, train_gt[img_ids, :]], axis=1), 'loss_pred', nonlin='relu'), args.repeat, axis=0)
-				cost_encoder = T.mean((reconstruction_loss - baseline.T) * T.switch(latent_samples, T.log(latent_probs_r), T.log(1. - latent_probs_r)).sum(axis=1))
+				# conditional mean is subtracted from the reconstruction loss to lower variance further, one prediction per image
+				baseline = T.addbroadcast(fflayer(tparams, T.concatenate([img, gt_unrepeated], axis=1), 'loss_pred', nonlin='relu'), 1)
+				cost_encoder = T.mean((reconstruction_loss - baseline) * log_probs)
 
 				# optimizing the predictor
-				cost_pred = T.mean((reconstruction_loss - baseline.T) ** 2)
+				cost_pred = T.mean((reconstruction_loss - baseline) ** 2)
 				
 				params_loss_predictor = [val for key, val in tparams.iteritems() if 'loss_pred' in key]
 				print "Loss predictor parameters:", params_loss_predictor
@@ -445,17 +548,20 @@ if args.mode == 'train':
 
 		if args.latent_type =='disc':
 			# equivalent to stop_gradient trick in tensorflow
-			grads = T.grad(cost, wrt=param_list + [latent_probs], consider_constant=[dummy])
+			# the gradients wrt the samples are those of the probabilities of every sample
+			grads = T.grad(cost, wrt=param_list + [latent_samples], consider_constant=[dummy])
 			xtranorm = T.mean(grads[-1] ** 2)
 			grads = grads[:-1]
 			
 		elif args.latent_type == 'cont':
 			print "Nothing defined for this state"
 
+	startup.mark('gradients')
+
 	# learning rate
 	lr = T.scalar('lr', dtype='float32')
 
-	inps = [img_ids]
+	inps = list(inps_data)
 	if args.estimator == 'PD' and args.latent_type == 'disc':
 		inps += [temperature]
 		temperature_min = temperature_init/2.0
@@ -471,53 +577,281 @@ if args.mode == 'train':
 		else:
 			tparams_net[key] = val
 	
+	if args.val_freq > 0:
+		print "Constructing graph for validation"
+		# the test set is evaluated in test mode on the parameters being trained
+		val_top, val_bot = read_arrays(dataset='testing', path=args.data_path, binarize=100, split=True, cache=True, shared=args.shared_data)
+		startup.mark('data load')
+		val = theano.shared(val_top, name='val', borrow=True)
+		val_gt = theano.shared(val_bot, name='val_gt', borrow=True)
+		val_ids = T.vector('val_ids', dtype='int64')
+		val_losses = test_losses(tparams, val[val_ids,:], val_gt[val_ids,:], args.num_samples)
+		startup.mark('graph build')
+
+	if args.workers > 1 and (args.fused_step or args.steps_per_call > 1 or args.stream_buffer > 0):
+		raise ValueError, "Data parallel workers average the gradient buffers of the unfused step over in-memory data, use --fused_step 0 --steps_per_call 1 --stream_buffer 0"
+	if args.workers > 1 and theano.config.device != 'cpu':
+		# the forked workers (synchronous or hogwild) cannot use the device context of their parent
+		raise ValueError, "Data parallel workers run in forked processes and are CPU only, use device=cpu"
+
 	print "Setting up optimizer"
-	f_grad_shared, f_update = adam(lr, tparams_net, grads, inps, [cost, xtranorm], ups=updates_bn)
+	# f_multi_step runs a block of minibatches in one call, f_grad_shared (fused) is used for the leftover batches of an epoch
+	if args.steps_per_call > 1:
+		args.fused_step = 1
+	if args.fused_step:
+		# the compiled step also applies the update, the learning rate is held in a shared variable instead
+		lr = theano.shared(np.float32(args.learning_rate), name='lr')
+
+	# shared variables set by this script, cached functions come with their own copies which take these values
+	script_shared = OrderedDict((key, val) for key, val in tparams.iteritems() if isinstance(val, theano.compile.SharedVariable))
+	if args.stream_buffer == 0:
+		script_shared['train'] = train
+		script_shared['train_gt'] = train_gt
+		if args.device_perm:
+			script_shared['perm'] = perm
+	if args.fused_step:
+		script_shared['lr'] = lr
+	if args.val_freq > 0:
+		script_shared['val'] = val
+		script_shared['val_gt'] = val_gt
+
+	functions = None
+	if args.compile_cache:
+		# arguments that leave the compiled graph unchanged
+		run_args = ['learning_rate', 'slash_rate', 'term_condition', 'num_epochs', 'min_cost', 'save_freq', 'base_code', 'load', 'val_file', 'shared_data', 'data_path', 'resume', 'compile_cache', 'val_freq', 'eval_chunk', 'workers', 'hogwild', 'max_staleness']
+		graph_args = dict((k, v) for k, v in vars(args).iteritems() if k not in run_args)
+		graph_args['validation'] = args.val_freq > 0
+		if args.val_freq == 0:
+			del graph_args['num_samples']
+		functions_file = cache_file('main', graph_args)
+		functions, replaced = load_functions(functions_file, script_shared)
+
+	if functions is None:
+		functions = OrderedDict()
+		if args.steps_per_call > 1:
+			functions['f_grad_shared'], functions['f_multi_step'] = adam_multistep(lr, tparams_net, grads, inps, [cost, xtranorm], args.steps_per_call, ups=updates_bn)
+		elif args.fused_step:
+			functions['f_grad_shared'] = adam_step(lr, tparams_net, grads, inps, [cost, xtranorm], ups=updates_bn)
+		else:
+			functions['f_grad_shared'], functions['f_update'] = adam(lr, tparams_net, grads, inps, [cost, xtranorm], ups=updates_bn)
+		if args.val_freq > 0:
+			functions['f_val'] = theano.function([val_ids], val_losses)
 
-	print "Training"
-	cost_report = open('./Results/' + args.latent_type + '/' + args.estimator + '/training_' + code_name + '_' + str(args.batch_size) + '_' + str(args.learning_rate) + '.txt', 'w')
-	id_order = range(len(trc))
+		if args.compile_cache:
+			save_functions(functions_file, functions, script_shared)
+	else:
+		print "Loaded the compiled functions from " + functions_file
+		for key in tparams:
+			if key in replaced:
+				tparams[key] = replaced[key]
+		if 'lr' in replaced:
+			lr = replaced['lr']
+		if 'perm' in replaced:
+			perm = replaced['perm']
+
+	f_grad_shared = functions['f_grad_shared']
+	f_update = functions.get('f_update')
+	f_multi_step = functions.get('f_multi_step')
+	f_val = functions.get('f_val')
+	# validation draws its own samples and is left out of the training state
+	train_functions = [f for key, f in functions.iteritems() if key != 'f_val']
+	startup.mark('compile')
+	startup.report()
+
+	# everything needed to continue the run exactly: shared variables updated by training (parameters,
+	# optimizer and batchnorm state, random streams), loop counters and the random state of the minibatches
+	state_vars = state_variables(train_functions)
+	state_file = './Results/' + args.latent_type + '/' + args.estimator + '/training_' + code_name + '_' + str(args.batch_size) + '_' + str(init_rate) + '.state'
+	loop = {'epoch': 0, 'batch': 0, 'iters': 0, 'cur_temp': temperature_init, 'min_cost': 100000.0, 'epoch_cost': 0., 'learning_rate': args.learning_rate, 'metrics_offset': None, 'val_offset': None}
+	rng_state = None
+	if args.resume and os.path.exists(state_file):
+		loop, rng_state = restore(state_vars, load(state_file))
+		args.learning_rate = loop['learning_rate']
+		if args.fused_step:
+			lr.set_value(np.float32(args.learning_rate))
+		print "Resuming from epoch " + str(loop['epoch'] + 1) + ", batch " + str(loop['batch'])
+
+	# a worker takes part batch_part out of batch_parts of every minibatch, shifted by first_image
+	rank = 0
+	batch_seed = None
+	batch_parts, batch_part, first_image = 1, 0, 0
+	if args.workers > 1 and args.hogwild:
+		# parameters, optimizer and batchnorm state live in shared memory, updated by each worker on its own
+		grad_buffers = [var for var in state_variables([f_grad_shared]) if var.name is not None and var.name.endswith('_grad')]
+		async_vars = [var for var in state_vars if var not in grad_buffers and isinstance(var.get_value(borrow=True), np.ndarray) and var.dtype == theano.config.floatX]
+		data_parallel = AsyncParameters(args.workers, async_vars, args.max_staleness)
+		print "Forking " + str(args.workers) + " asynchronous workers"
+		rank = data_parallel.start()
+		# every worker shuffles its own part of the training set
+		first_image = rank * (len(top) / args.workers)
+	elif args.workers > 1:
+		# gradient buffers and batchnorm running statistics are averaged over the workers after every step,
+		# together with the outputs and the stop requests
+		grad_buffers = [var for var in state_variables([f_grad_shared]) if var.name is not None and var.name.endswith('_grad')]
+		bn_stats = [val for key, val in tparams.iteritems() if ('rm' in key or 'rv' in key) and not ('rmu' in key or 'rvu' in key)]
+		data_parallel = GradientAverager(args.workers, grad_buffers + bn_stats, num_extra=3)
+		# every worker draws the same permutations and takes its own part of each global batch
+		batch_seed = np.random.randint(2**31 - 1)
+		print "Forking " + str(args.workers) + " data parallel workers"
+		rank = data_parallel.start()
+		batch_parts, batch_part = args.workers, rank
 
-	iters = 0
-	cur_temp = temperature_init
-	min_cost = 100000.0
-	epoch = 0
+	print "Training"
+	if args.stream_buffer > 0:
+		stream = lambda: read_chunks(dataset='training', path=args.data_path, binarize=100, split=True)
+		batches = ShuffleBuffer(stream, args.batch_size, args.stream_buffer)
+		# the length of the stream is not known in advance
+		steps_per_epoch = None
+	else:
+		# shuffled minibatches are prepared by a background thread while the compiled functions run
+		# (asynchronous workers shuffle len(top) / args.workers images each)
+		batches = BatchIterator(len(top) / (args.workers / batch_parts), args.batch_size * batch_parts, seed=batch_seed)
+		steps_per_epoch = batches.num_batches
+	if rng_state is not None:
+		batches.restart(rng_state)
+
+	if args.workers > 1:
+		# every worker draws its own latent samples
+		decorrelate(state_vars, rank, [args.random_seed, loop['iters']])
+	if rank > 0:
+		# only the first worker writes metrics, checkpoints and the training state
+		loop['metrics_offset'] = loop['val_offset'] = None
+
+	# binary records, buffered in memory and written by a background thread
+	cost_report = MetricsLogger('./Results/' + args.latent_type + '/' + args.estimator + '/training_' + code_name + '_' + str(args.batch_size) + '_' + str(init_rate) + '.bin' if rank == 0 else os.devnull, ['epoch', 'batch', 'cost', 'xtra', 'time'], batch_size=args.batch_size * batch_parts, steps_per_epoch=steps_per_epoch, offset=loop['metrics_offset'])
+	if args.val_freq > 0:
+		val_report = MetricsLogger('./Results/' + args.latent_type + '/' + args.estimator + '/validation_' + code_name + '_' + str(args.batch_size) + '_' + str(init_rate) + '.bin' if rank == 0 else os.devnull, ['epoch', 'loss', 'stderr', 'time'], offset=loop.get('val_offset'))
+	# checkpoints are written by a background thread
+	checkpoints = CheckpointWriter()
+	# SIGTERM stops training after the current step, with the training state written out
+	stop = StopRequest()
+
+	def save_state(epoch, first_batch, epoch_cost, rng_state):
+		if rank > 0:
+			return
+		cost_report.flush()
+		loop = {'epoch': epoch, 'batch': first_batch, 'iters': iters, 'cur_temp': cur_temp, 'min_cost': min_cost, 'epoch_cost': epoch_cost,
+				'learning_rate': args.learning_rate, 'metrics_offset': cost_report.offset, 'val_offset': None}
+		if args.val_freq > 0:
+			loop['val_offset'] = val_report.offset
+		checkpoints.save_state(state_file, capture(state_vars, loop, rng_state))
+
+	iters = loop['iters']
+	cur_temp = loop['cur_temp']
+	min_cost = loop['min_cost']
+	epoch = loop['epoch']
+	epoch_cost = loop['epoch_cost']
+	# batches of the current epoch that were done before resuming
+	first_batch = loop['batch']
 	condition = False
+	stopping = False
 
 	while condition == False:
-		if iters != 0 and iters % (20 * 600) == 0 and args.learning_rate > 1e-7:
-			args.learning_rate /= args.slash_rate
-			print "Updated main network learning rate:", args.learning_rate
+		# a resumed epoch continues with its learning rate and cost
+		if first_batch == 0:
+			if iters != 0 and iters % (20 * 600) == 0 and args.learning_rate > 1e-7:
+				args.learning_rate /= args.slash_rate
+				print "Updated main network learning rate:", args.learning_rate
+				if args.fused_step:
+					lr.set_value(np.float32(args.learning_rate))
+			epoch_cost = 0.
 
 		print "Epoch " + str(epoch + 1),
 
-		np.random.shuffle(id_order)
-		epoch_cost = 0.
 		epoch_start = time.time()
-		for batch_id in range(len(trc)/args.batch_size):
+
+		# minibatches are processed in blocks of args.steps_per_call, one block per call of f_multi_step
+		epoch_batches = enumerate(batches.epoch(skip=first_batch), first_batch)
+		for block in iter(lambda: list(itertools.islice(epoch_batches, args.steps_per_call)), []):
 			batch_start = time.time()
-			iters += 1
-
-			idlist = id_order[batch_id*args.batch_size:(batch_id+1)*args.batch_size]
-			if args.estimator == 'PD' and args.latent_type == 'disc':
-				# fprint(idlist, cur_temp)
-				cost = f_grad_shared(idlist, cur_temp)
-				if iters % 1000 == 0:
-					cur_temp = np.maximum(temperature_init*np.exp(-anneal_rate*iters, dtype=np.float32), temperature_min)
+
+			inps_block = []
+			# step counts the steps done before each minibatch of the block
+			for step, (batch_id, batch) in enumerate(block, iters):
+				# streamed batches are (top, bottom) arrays, otherwise an array of image ids
+				if args.stream_buffer > 0:
+					inps_batch = list(batch)
+				elif args.device_perm:
+					if batch_id == first_batch:
+						perm.set_value(batches.permutation + first_image, borrow=True)
+					# with data parallel workers, batch_size images of the global batch each
+					inps_batch = [batch_id * batch_parts + batch_part]
+				else:
+					inps_batch = [batch[batch_part * args.batch_size:(batch_part + 1) * args.batch_size] + first_image]
+
+				if args.estimator == 'PD' and args.latent_type == 'disc':
+					# annealed per step, so every step of a block uses the temperature it gets with single steps
+					if step > 0 and step % 1000 == 0:
+						cur_temp = np.maximum(temperature_init*np.exp(-anneal_rate*step, dtype=np.float32), temperature_min)
+					inps_batch += [cur_temp]
+				inps_block.append(inps_batch)
+
+			if len(block) > 1 and len(block) == args.steps_per_call:
+				# costs of every step are returned as vectors
+				outs_block = zip(*f_multi_step(*[np.asarray(inp) for inp in zip(*inps_block)]))
 			else:
-				# fprint(idlist)
-				cost, xtra = f_grad_shared(idlist)	
+				outs_block = []
+				for inps_batch in inps_block:
+					# fprint(idlist)
+					if args.workers > 1 and args.hogwild:
+						data_parallel.pull()
+					outs = f_grad_shared(*inps_batch)
+					if args.workers > 1 and not args.hogwild:
+						outs = data_parallel.average(list(outs) + [stop.requested])
+						# all workers stop at the same step, as soon as one of them is asked to
+						stopping = outs[2] > 0
+						outs = outs[:2]
+					outs_block.append(outs)
+					if not args.fused_step:
+						f_update(args.learning_rate)
+					if args.workers > 1 and args.hogwild:
+						# all workers stop after their current step, as soon as one of them is asked to
+						stopping = data_parallel.push(stop.requested)
+
+			# time per minibatch within the block
+			batch_time = (time.time() - batch_start) / len(block)
+
+			for (batch_id, batch), (cost, xtra) in zip(block, outs_block):
+				iters += 1
 				min_cost = min(min_cost, cost)
-			
-			f_update(args.learning_rate)
 
-			epoch_cost += cost
-			cost_report.write(str(epoch) + ',' + str(batch_id) + ',' + str(cost) + ',' + str(xtra) + ',' + str(time.time() - batch_start) + '\n')
+				epoch_cost += cost
+				cost_report.log(epoch, batch_id, cost, xtra, batch_time)
+
+			if args.workers == 1:
+				stopping = stop.requested
+			if stopping:
+				break
+
+		if stopping:
+			print "\nStopping, saving the training state...",
+			if args.workers > 1 and args.hogwild:
+				data_parallel.pull(wait=False)
+			save_state(epoch, batch_id + 1, epoch_cost, batches.start_state)
+			checkpoints.close()
+			print "Done!"
+			if args.workers > 1:
+				data_parallel.join(143)
+			sys.exit(143)
 
 		print ": Cost " + str(epoch_cost) + " : Time " + str(time.time() - epoch_start)
+		cost_report.flush()
+		first_batch = 0
+
+		if args.workers > 1 and args.hogwild and rank == 0:
+			# validation and checkpoints get the latest shared values (the next step starts from them anyway)
+			data_parallel.pull(wait=False)
+
+		# validation on the weights being trained, without leaving the process
+		if args.val_freq > 0 and (epoch + 1) % args.val_freq == 0 and rank == 0:
+			val_start = time.time()
+			val_stats = evaluate(f_val, len(val_top), args.eval_chunk)
+			print "Validation : Cost " + str(val_stats.mean) + " +- " + str(val_stats.stderr()) + " : Time " + str(time.time() - val_start)
+			val_report.log(epoch, val_stats.mean, val_stats.stderr(), time.time() - val_start)
+			val_report.flush()
 		
 		# save every args.save_freq epochs
-		if (epoch + 1) % args.save_freq == 0:
+		if (epoch + 1) % args.save_freq == 0 and rank == 0:
 			print "Saving...",
 
 			params = {}
@@ -525,8 +859,10 @@ if args.mode == 'train':
 				if not (('rmu' in key) or ('rvu' in key)):
 					params[key] = val.get_value()
 
-			# numpy saving
-			np.savez('./Results/' + args.latent_type + '/' + args.estimator + '/training_' + code_name + '_' + str(args.batch_size) + '_' + str(init_rate) + '_' + str(epoch+1) + '.npz', **params)
+			# numpy saving, in the background
+			checkpoints.save('./Results/' + args.latent_type + '/' + args.estimator + '/training_' + code_name + '_' + str(args.batch_size) + '_' + str(init_rate) + '_' + str(epoch+1) + '.npz', params)
+			# full training state, to continue with the next epoch
+			save_state(epoch + 1, 0, 0., batches.end_state)
 			print "Done!"
 
 		epoch += 1
@@ -534,7 +870,17 @@ if args.mode == 'train':
 			condition = True
 		elif args.term_condition == 'epochs' and epoch >= args.num_epochs:
 			condition = True
-	
+
+	cost_report.close()
+	if args.val_freq > 0:
+		val_report.close()
+
+	if args.workers > 1:
+		# the other workers end here, the first one saves the final model once they are done
+		data_parallel.join()
+		if args.hogwild:
+			data_parallel.pull(wait=False)
+
 	# saving the final model
 	if epoch % args.save_freq != 0:
 		print "Saving...",
@@ -543,34 +889,35 @@ if args.mode == 'train':
 				if not (('rmu' in key) or ('rvu' in key)):
 					params[key] = val.get_value()
 
-		# numpy saving
-		np.savez('./Results/' + args.latent_type + '/' + args.estimator + '/training_' + code_name + '_' + str(args.batch_size) + '_' + str(init_rate) + '_' + str(epoch) + '.npz', **params)
+		# numpy saving, in the background
+		checkpoints.save('./Results/' + args.latent_type + '/' + args.estimator + '/training_' + code_name + '_' + str(args.batch_size) + '_' + str(init_rate) + '_' + str(epoch) + '.npz', params)
+		# full training state, the run can be continued with more epochs
+		save_state(epoch, 0, 0., batches.end_state)
 		print "Done!"
 
+	checkpoints.close()
+
 # Test
 else:
-	# useful for one example at a time only
-	loss = T.mean(T.nnet.binary_crossentropy(probs, gt))
+	# loss of every image averaged over args.num_samples latent samples, the test set is
+	# streamed through in chunks of args.eval_chunk images
+	losses = test_losses(tparams, img, gt, args.num_samples)
 
 	# compiling test function
-	inps = [img_ids]
-	if args.estimator == 'PD' and args.latent_type =='disc':
-		inps += [temperature]
-
-	f = theano.function(inps, [loss])
-	if args.estimator == 'PD' and args.latent_type =='disc':
-		loss = f(range(len(tec)), 0.5)
-	else:
-		loss = f(range(len(tec)))
+	f = theano.function([img_ids], losses)
+	stats = evaluate(f, len(top), args.eval_chunk)
+	loss = [stats.mean, stats.stderr()]
 
 	# show(tec[idx].reshape(28,28))
 
 	# reconstructed_img = np.zeros((28*28,))
-	# reconstructed_img[:14*28] = tep[idx][0]
+	# reconstructed_img[:14*28] = top[idx]
 	# reconstructed_img[14*28:] = pred
 	# show(reconstructed_img.reshape(28,28))
 	if args.val_file is None:
-		print loss
+		print "Cost " + str(loss[0]) + " +- " + str(loss[1]) + " (" + str(stats.count) + " images, " + str(args.num_samples) + " samples each)"
 	else:
 		val_report = open(args.val_file, 'a')
+		# one value per line, the standard error is only printed
+		print "Cost " + str(loss[0]) + " +- " + str(loss[1]) + " (" + str(stats.count) + " images, " + str(args.num_samples) + " samples each)"
 		val_report.write(str(loss[0]) + '\n')
\ No newline at end of file
@@ -0,0 +1,178 @@
+import atexit
+import threading
+import Queue
+from collections import OrderedDict
+import numpy as np
+
+'''
+Binary training metrics, stored column by column. A file starts with a single text line
+describing the run, for example
+
+# metrics columns=epoch,batch,cost,time batch_size=100 steps_per_epoch=600
+
+followed by blocks of float64 values in native byte order. Each block is its number of rows n,
+then the n values of the first column, the n values of the second one and so on.
+'''
+
+class MetricsLogger():
+	'''
+	Appends float records to a preallocated ring of blocks in memory. Filled blocks are written
+	to disk by a background thread, so the training loop never formats strings or waits on I/O
+	(unless every block is still waiting to be written).
+	With offset, an existing file is continued from that position (the offset attribute of an
+	earlier logger after flush), dropping the records written after it.
+	'''
+	def __init__(self, fname, columns, batch_size=None, steps_per_epoch=None, block_size=1024, num_blocks=4, offset=None):
+		self.fname = fname
+		self.columns = list(columns)
+		self.ring = np.empty((num_blocks, len(self.columns), block_size), dtype=np.float64)
+
+		# blocks travel between the two queues: free ones are filled here, full ones are written by the thread
+		self.free = Queue.Queue()
+		self.full = Queue.Queue()
+		for block in range(1, num_blocks):
+			self.free.put(block)
+		self.block = 0
+		self.row = 0
+
+		header = '# metrics columns=' + ','.join(self.columns)
+		if batch_size is not None:
+			header += ' batch_size=' + str(batch_size)
+		if steps_per_epoch is not None:
+			header += ' steps_per_epoch=' + str(steps_per_epoch)
+
+		if offset is None:
+			self.f = open(fname, 'wb')
+			self.f.write(header + '\n')
+			self.offset = len(header) + 1
+		else:
+			self.f = open(fname, 'r+b')
+			self.f.truncate(offset)
+			self.f.seek(offset)
+			self.offset = offset
+
+		self.thread = threading.Thread(target=self._write)
+		self.thread.daemon = True
+		self.thread.start()
+		self.closed = False
+
+		# records still in memory are written out if the script ends without closing the logger
+		atexit.register(self.close)
+
+	def _write(self):
+		while True:
+			item = self.full.get()
+			if item is None:
+				break
+
+			block, rows = item
+			np.float64(rows).tofile(self.f)
+			np.ascontiguousarray(self.ring[block, :, :rows]).tofile(self.f)
+			self.f.flush()
+			self.free.put(block)
+
+	def log(self, *values):
+		'''
+		Records one row, values are given in the order of the columns (use nan for missing values)
+		'''
+		self.ring[self.block, :, self.row] = values
+		self.row += 1
+		if self.row == self.ring.shape[2]:
+			self.flush()
+
+	def flush(self):
+		'''
+		Hands the current (possibly partial) block over to the writer thread
+		'''
+		if self.row > 0:
+			self.full.put((self.block, self.row))
+			# size of the file once the writer is done with this block
+			self.offset += 8 * (1 + len(self.columns) * self.row)
+			self.block = self.free.get()
+			self.row = 0
+
+	def close(self):
+		if self.closed:
+			return
+
+		self.closed = True
+		self.flush()
+		self.full.put(None)
+		self.thread.join()
+		self.f.close()
+
+def read_metrics(fname):
+	'''
+	Returns the header of a metrics file (dict, with the column names under 'columns')
+	and its records (OrderedDict from column name to array)
+	'''
+	with open(fname, 'rb') as f:
+		header = {}
+		for field in f.readline().split()[2:]:
+			key, value = field.split('=', 1)
+			header[key] = value.split(',') if key == 'columns' else int(value)
+		body = np.fromfile(f, dtype=np.float64)
+
+	ncols = len(header['columns'])
+
+	# only the block boundaries are walked in python, every block holds up to block_size rows
+	starts = []
+	rows = []
+	pos = 0
+	while pos < len(body):
+		n = int(body[pos])
+		starts.append(pos + 1)
+		rows.append(n)
+		pos += 1 + ncols * n
+
+	records = OrderedDict()
+	for c, name in enumerate(header['columns']):
+		records[name] = np.concatenate([body[s + c*n:s + (c+1)*n] for s, n in zip(starts, rows)] or [np.empty(0)])
+
+	return header, records
+
+def epoch_summary(records, column='cost', percentiles=(50, 90)):
+	'''
+	Per-epoch aggregates of one column, computed with a group-by over the epoch column.
+	records is the output of read_metrics (or a file name). Missing values (nan) are ignored.
+	Returns a dict of arrays indexed like 'epoch': count, sum, mean, min, max and p<q> for every percentile.
+	'''
+	if isinstance(records, basestring):
+		records = read_metrics(records)[1]
+
+	values = records[column]
+	keep = ~np.isnan(values)
+	values = values[keep]
+	epochs = records['epoch'][keep].astype(np.int64)
+
+	# group rows by epoch (the logs are written in epoch order, so this is normally a no-op)
+	if np.any(epochs[1:] < epochs[:-1]):
+		order = np.argsort(epochs, kind='mergesort')
+		values = values[order]
+		epochs = epochs[order]
+	epoch, start, count = np.unique(epochs, return_index=True, return_counts=True)
+
+	summary = {'epoch': epoch, 'count': count}
+	if len(values) == 0:
+		for key in ['sum', 'mean', 'min', 'max'] + ['p' + str(q) for q in percentiles]:
+			summary[key] = np.empty(0)
+		return summary
+
+	summary['sum'] = np.add.reduceat(values, start)
+	summary['mean'] = summary['sum'] / count
+	summary['min'] = np.minimum.reduceat(values, start)
+	summary['max'] = np.maximum.reduceat(values, start)
+
+	if len(percentiles) > 0:
+		# sorting by epoch, then by value, puts every epoch in an ordered run
+		values = values[np.lexsort((values, epochs))]
+
+	# linear interpolation between the closest ranks, as np.percentile does
+	for q in percentiles:
+		pos = (count - 1) * (q / 100.)
+		lower = np.floor(pos).astype(np.int64)
+		upper = np.minimum(lower + 1, count - 1)
+		frac = pos - lower
+		summary['p' + str(q)] = values[start + lower] * (1. - frac) + values[start + upper] * frac
+
+	return summary
@@ -0,0 +1,477 @@
+import os
+import sys
+import time
+import Queue
+import traceback
+import multiprocessing
+import numpy as np
+from theano.sandbox.rng_mrg import ff_2p134
+
+'''
+Data parallel training over forked processes, which run the same compiled functions on their own minibatches.
+In the synchronous mode (GradientAverager) the workers average their gradient buffers (and batchnorm running
+statistics and outputs) through shared memory after each gradient computation, so that they all apply the same
+update and their parameters stay identical. In the asynchronous mode (AsyncParameters) the training state lives
+in shared memory and every worker adds its own updates to it without waiting for the others (Hogwild).
+AsyncTrainer moves a part of the training (such as a synthetic gradient subnetwork) to a forked process of its own,
+and Pipeline runs the layers of a network trained with synthetic gradients as stages in processes of their own.
+'''
+
+class Barrier():
+	'''
+	Reusable barrier for forked processes (multiprocessing has none in python 2)
+	'''
+	def __init__(self, parties):
+		self.parties = parties
+		self.count = multiprocessing.Value('i', 0, lock=False)
+		self.generation = multiprocessing.Value('i', 0, lock=False)
+		self.cond = multiprocessing.Condition()
+
+	def wait(self):
+		with self.cond:
+			generation = self.generation.value
+			self.count.value += 1
+			if self.count.value == self.parties:
+				self.count.value = 0
+				self.generation.value += 1
+				self.cond.notify_all()
+			else:
+				while generation == self.generation.value:
+					self.cond.wait()
+
+def shared_array(shape, dtype=np.float32):
+	'''
+	Zero initialized array in shared memory, visible to the processes forked after its creation
+	'''
+	dtype = np.dtype(dtype)
+	raw = multiprocessing.RawArray('b', int(np.prod(shape)) * dtype.itemsize)
+	return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+class Workers():
+	'''
+	Worker processes forked from the training script. The values of variables (shared variables, in this order)
+	are kept side by side in flat arrays of size self.num_values, self.offsets delimits them.
+	'''
+	def __init__(self, num_workers, variables):
+		self.num_workers = num_workers
+		self.variables = variables
+		self.shapes = [var.get_value(borrow=True).shape for var in variables]
+		self.offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in self.shapes])
+		self.num_values = self.offsets[-1]
+
+		self.rank = 0
+		self.children = []
+
+	def slices(self):
+		return zip(self.variables, self.shapes, self.offsets[:-1], self.offsets[1:])
+
+	def start(self):
+		'''
+		Forks the other workers, which continue from here with their own rank and no output on stdout.
+		Returns the rank of the calling process (0 for the original one).
+		'''
+		for rank in range(1, self.num_workers):
+			sys.stdout.flush()
+			pid = os.fork()
+			if pid == 0:
+				self.rank = rank
+				self.children = []
+				sys.stdout = open(os.devnull, 'w')
+				return rank
+			self.children.append(pid)
+
+		return 0
+
+	def join(self, status=0):
+		'''
+		Ends the forked workers with status and waits for them in the first one. The forked workers leave without
+		running the exit handlers, theano's would remove compiled modules that the first worker still uses.
+		'''
+		if self.rank > 0:
+			sys.stdout.flush()
+			sys.stderr.flush()
+			os._exit(status)
+
+		for pid in self.children:
+			os.waitpid(pid, 0)
+		self.children = []
+
+class GradientAverager(Workers):
+	'''
+	Averages the values of shared variables (and a few extra numbers) over the workers after every step.
+	The buffer has one row per worker; after every worker has written its row, each one averages its own part
+	of the columns, then all of them read back the full average. Create it before start() forks the workers.
+	'''
+	def __init__(self, num_workers, variables, num_extra=0):
+		Workers.__init__(self, num_workers, variables)
+		size = self.num_values + num_extra
+
+		self.rows = shared_array((num_workers, size))
+		self.mean = shared_array((size,))
+		# columns averaged by each worker
+		self.parts = np.linspace(0, size, num_workers + 1).astype(np.int64)
+		self.barrier = Barrier(num_workers)
+
+	def average(self, extra=()):
+		'''
+		Replaces the values of the variables by their average over the workers, returns the average of extra
+		'''
+		row = self.rows[self.rank]
+		for var, shape, start, end in self.slices():
+			row[start:end] = np.ravel(var.get_value(borrow=True))
+		row[self.num_values:] = extra
+		self.barrier.wait()
+
+		start, end = self.parts[self.rank], self.parts[self.rank + 1]
+		self.mean[start:end] = self.rows[:, start:end].mean(axis=0)
+		self.barrier.wait()
+
+		for var, shape, start, end in self.slices():
+			var.set_value(self.mean[start:end].reshape(shape))
+		return self.mean[self.num_values:].copy()
+
+class AsyncParameters(Workers):
+	'''
+	Training state (parameters, optimizer state, batchnorm running statistics) shared by the workers without locks.
+	A step starts from a private copy of the shared values (pull) and adds the changes it made to them (push),
+	updates of other workers made in between are kept. With max_staleness >= 0, a worker does not start a step
+	while it is more than max_staleness steps ahead of the slowest one. Create it before start() forks the workers.
+	'''
+	def __init__(self, num_workers, variables, max_staleness=-1):
+		Workers.__init__(self, num_workers, variables)
+		self.max_staleness = max_staleness
+
+		self.values = shared_array((self.num_values,))
+		for var, shape, start, end in self.slices():
+			self.values[start:end] = np.ravel(var.get_value(borrow=True))
+		# values at the start of the current step
+		self.pulled = np.empty_like(self.values)
+		# steps done by every worker, and a flag set by the first stop request
+		self.clock = shared_array((num_workers,), np.int64)
+		self.stop = shared_array((1,), np.int64)
+
+	def pull(self, wait=True):
+		'''
+		Sets the variables to the shared values
+		'''
+		if wait and self.max_staleness >= 0:
+			while self.clock[self.rank] - self.clock.min() > self.max_staleness:
+				time.sleep(1e-4)
+
+		self.pulled[:] = self.values
+		for var, shape, start, end in self.slices():
+			var.set_value(self.pulled[start:end].reshape(shape))
+
+	def push(self, stop=False):
+		'''
+		Adds the changes of the variables since the last pull to the shared values.
+		Returns whether a worker has asked to stop (stop is the request of this one).
+		'''
+		for var, shape, start, end in self.slices():
+			self.values[start:end] += np.ravel(var.get_value(borrow=True)) - self.pulled[start:end]
+		self.clock[self.rank] += 1
+
+		if stop:
+			self.stop[0] = 1
+		return self.stop[0] > 0
+
+	def join(self, status=0):
+		# a worker that is done no longer holds the others back
+		self.clock[self.rank] = np.iinfo(np.int64).max / 2
+		Workers.join(self, status)
+
+class AsyncTrainer(Workers):
+	'''
+	Trains some shared variables in a forked process, on the inputs that the training loop submits to a bounded queue.
+	Every publish_freq steps the trainer copies the values of the variables to shared memory, the training loop takes
+	them with refresh(). The training loop never waits for the trainer: inputs are dropped while the queue is full.
+	train is a compiled function taking the submitted inputs and returning a cost. The training loop can change the
+	shared variables in controls (such as a learning rate) with set_value. Create it before start().
+	'''
+	def __init__(self, variables, train, max_pending=4, publish_freq=10, controls=()):
+		Workers.__init__(self, 2, variables)
+		self.train = train
+		self.publish_freq = publish_freq
+		self.controls = list(controls)
+
+		self.queue = multiprocessing.Queue(max_pending)
+		self.lock = multiprocessing.Lock()
+		self.values = shared_array((self.num_values,))
+		# number of publications, and the number of steps, sum and last value of the costs of the trainer
+		self.version = shared_array((1,), np.int64)
+		self.stats = shared_array((3,), np.float64)
+		self.seen = 0
+		self.dropped = 0
+
+	def start(self):
+		'''
+		Forks the trainer, which runs until close(). Returns in the training loop only.
+		'''
+		self.parent = os.getpid()
+		if Workers.start(self) > 0:
+			status = 0
+			try:
+				self._run()
+			except Exception:
+				traceback.print_exc()
+				status = 1
+			self.join(status)
+		return 0
+
+	def _run(self):
+		steps = 0
+		while True:
+			try:
+				inps = self.queue.get(timeout=1.)
+			except Queue.Empty:
+				# the training loop is gone without closing the trainer
+				if os.getppid() != self.parent:
+					return
+				continue
+			if inps is None:
+				break
+
+			control, inps = inps
+			if control is not None:
+				self.controls[control].set_value(inps)
+				continue
+
+			cost = self.train(*inps)
+			steps += 1
+			self.stats[:] = [steps, self.stats[1] + cost, cost]
+			if steps % self.publish_freq == 0:
+				self._publish()
+
+		self._publish()
+
+	def _publish(self):
+		with self.lock:
+			for var, shape, start, end in self.slices():
+				self.values[start:end] = np.ravel(var.get_value(borrow=True))
+			self.version[0] += 1
+
+	def submit(self, *inps):
+		'''
+		Queues the inputs of a step of the trainer. Returns False if they were dropped because the queue is full.
+		'''
+		try:
+			self.queue.put_nowait((None, inps))
+			return True
+		except Queue.Full:
+			self.dropped += 1
+			return False
+
+	def set_value(self, var, value):
+		'''
+		Sets one of the controls in the trainer, after the steps queued before
+		'''
+		self.queue.put((self.controls.index(var), value))
+
+	def refresh(self):
+		'''
+		Sets the variables to the values published last, if they are newer than those set before.
+		Returns whether they changed.
+		'''
+		if self.version[0] == self.seen:
+			return False
+
+		with self.lock:
+			self.seen = self.version[0]
+			for var, shape, start, end in self.slices():
+				var.set_value(self.values[start:end].reshape(shape))
+		return True
+
+	def close(self):
+		'''
+		Lets the trainer finish the queued steps, waits for it and takes its final values
+		'''
+		while True:
+			try:
+				self.queue.put(None, timeout=1.)
+				break
+			except Queue.Full:
+				# a trainer that failed no longer takes its inputs
+				pid, status = os.waitpid(self.children[0], os.WNOHANG)
+				if pid != 0:
+					self.children = []
+					break
+
+		self.join()
+		self.refresh()
+
+class Pipeline(Workers):
+	'''
+	Layers trained with synthetic gradients as a pipeline of stages, one process per stage: the first stages run
+	in forked workers and the last one in the calling process. Every stage updates its layer as soon as its own
+	forward pass is done, and sends its activations to the next stage through a bounded queue. The gradient wrt
+	the input of a stage goes back to the previous one, which trains its synthetic gradient module on it.
+
+	stages is a list of (step, train_sg, variables). step takes the ids of a minibatch and the activations of the
+	previous stage (none for the first one) and returns the activations of its layer (not for the last one), the
+	gradient wrt its input (not for the first one) and a cost, the costs of the stages are added up.
+	train_sg(ids, activations, gradient) trains the synthetic gradients of a stage (None for the last one) and
+	returns their cost. variables are the shared variables trained by the stage. Create it before start().
+	'''
+	def __init__(self, stages, depth=2):
+		Workers.__init__(self, len(stages), [var for step, train_sg, variables in stages for var in variables])
+		self.stages = stages
+		self.depth = depth
+		# stage of every variable
+		self.owners = [k for k, (step, train_sg, variables) in enumerate(stages) for var in variables]
+
+		# forward[k] brings the minibatches to stage k, backward[k] the gradients wrt its activations.
+		# Every stage takes all the gradients waiting before its next step, the backward queues stay short.
+		self.forward = [multiprocessing.Queue(depth) for stage in stages]
+		self.backward = [multiprocessing.Queue() for stage in stages]
+		self.values = shared_array((self.num_values,))
+		# sum of the synthetic gradient costs of every stage
+		self.sg_costs = shared_array((len(stages),), np.float64)
+		self.pending = 0
+
+	def stage(self):
+		return self.rank - 1 if self.rank > 0 else self.num_workers - 1
+
+	def start(self):
+		'''
+		Forks the first stages, which run until close(). Returns in the calling process only.
+		'''
+		if Workers.start(self) > 0:
+			status = 0
+			try:
+				self._run()
+			except Exception:
+				traceback.print_exc()
+				status = 1
+			self.join(status)
+		return 0
+
+	def _run(self):
+		k = self.stage()
+		while True:
+			item = self.forward[k].get()
+			if item is None or item[0] == 'publish':
+				self._publish()
+				self.forward[k + 1].put(item)
+				if item is None:
+					break
+				continue
+
+			self._train_sg()
+			self.forward[k + 1].put(self._step(item))
+
+		self._close_queues()
+
+	def _close_queues(self):
+		# the minibatches are written out before the process leaves, the gradients left for stages that are done are not
+		for queue in self.forward:
+			queue.close()
+			queue.join_thread()
+		for queue in self.backward:
+			queue.cancel_join_thread()
+
+	def _step(self, item):
+		k = self.stage()
+		step, train_sg, variables = self.stages[k]
+		tag, ids, inps, cost = item
+		outs = step(ids, *inps)
+		if k > 0:
+			self.backward[k - 1].put((ids, inps[0], outs[-2]))
+		return ('step', ids, outs[:1], cost + outs[-1])
+
+	def _train_sg(self):
+		k = self.stage()
+		step, train_sg, variables = self.stages[k]
+		while True:
+			try:
+				ids, activations, gradient = self.backward[k].get_nowait()
+			except Queue.Empty:
+				return
+			self.sg_costs[k] += train_sg(ids, activations, gradient)
+
+	def _publish(self):
+		k = self.stage()
+		for (var, shape, start, end), owner in zip(self.slices(), self.owners):
+			if owner == k:
+				self.values[start:end] = np.ravel(var.get_value(borrow=True))
+
+	def feed(self, ids):
+		'''
+		Sends a minibatch into the pipeline. Once the pipeline is full, runs the last stage on the oldest minibatch
+		in it and returns its cost (None otherwise).
+		'''
+		self.forward[0].put(('step', ids, [], 0.))
+		self.pending += 1
+		if self.pending > self.depth * (self.num_workers - 1):
+			return self.result()
+		return None
+
+	def result(self):
+		'''
+		Runs the last stage on the oldest minibatch in the pipeline, returns its cost (None if it is empty)
+		'''
+		if self.pending == 0:
+			return None
+		self.pending -= 1
+		return self._step(self._receive())[3]
+
+	def publish(self):
+		'''
+		Sets the variables of every stage in this process to their current values in the stages
+		(after the minibatches sent so far, which are run through the last stage without their costs)
+		'''
+		self._request(('publish',))
+
+	def close(self):
+		'''
+		Ends the stages after the minibatches sent so far, with their final values set as in publish
+		'''
+		self._request(None)
+		self.join()
+		for queue in self.backward:
+			queue.cancel_join_thread()
+
+	def _request(self, item):
+		self.forward[0].put(item)
+		# the minibatches ahead of the request go through the last stage
+		while True:
+			got = self._receive()
+			if got is None or got[0] == 'publish':
+				break
+			self.pending -= 1
+			self._step(got)
+
+		for (var, shape, start, end), owner in zip(self.slices(), self.owners):
+			if owner != self.stage():
+				var.set_value(self.values[start:end].reshape(shape))
+
+	def _receive(self):
+		while True:
+			try:
+				return self.forward[-1].get(timeout=1.)
+			except Queue.Empty:
+				pass
+
+			# a stage that failed would leave the last one waiting
+			for pid in list(self.children):
+				done, status = os.waitpid(pid, os.WNOHANG)
+				if done != 0:
+					self.children.remove(pid)
+					if status != 0:
+						raise RuntimeError, "A stage of the pipeline has failed"
+
+def decorrelate(variables, rank, seed):
+	'''
+	Gives every worker its own random streams: numpy generators are reseeded from (seed, rank) and the streams of
+	MRG generators jump ahead by rank * 2^134 draws. seed can be a list of ints.
+	'''
+	if rank == 0:
+		return
+
+	for i, var in enumerate(variables):
+		value = var.get_value()
+		if isinstance(value, np.random.RandomState):
+			var.set_value(np.random.RandomState(list(np.atleast_1d(seed)) + [rank, i]))
+		elif isinstance(value, np.ndarray) and value.dtype == np.int32 and value.shape[-1] == 6:
+			for _ in range(rank):
+				value = np.asarray([ff_2p134(state) for state in value], dtype=np.int32)
+			var.set_value(value)
@@ -1,6 +1,10 @@
 import sys
 
-f = open(sys.argv[1],'r').read().splitlines()
+from metrics import read_metrics, epoch_summary
+
+'''
+usage: python print_epoch_cost.py <file> <0: training metrics (.bin), 1: validation> [number of epochs] [column]
+'''
 
 # print training file
 if int(sys.argv[2]) == 0:
@@ -9,13 +13,22 @@ if int(sys.argv[2]) == 0:
 	else:
 		r = 1000
 
-	for i in range(r):
-		sum = 0.0
-		for j in range(600):
-			sum += float(f[i*600 + j].split(',')[2])
-		print "Epoch " + str(i+1) + ":", sum
+	if len(sys.argv) > 4:
+		column = sys.argv[4]
+	else:
+		column = 'cost'
+
+	header, records = read_metrics(sys.argv[1])
+	summary = epoch_summary(records, column)
+	print "Batch size:", header.get('batch_size', '?'), ": Steps per epoch:", header.get('steps_per_epoch', '?')
+	print "Epoch : Sum : Mean : Min : Median : 90th percentile"
+
+	for i in range(min(r, len(summary['epoch']))):
+		print "Epoch " + str(int(summary['epoch'][i]) + 1) + ":", summary['sum'][i], summary['mean'][i], summary['min'][i], summary['p50'][i], summary['p90'][i]
 # print validation
 else:
+	f = open(sys.argv[1],'r').read().splitlines()
+
 	if len(sys.argv) > 3:
 		r = int(sys.argv[3])
 	else:
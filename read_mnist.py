@@ -1,5 +1,8 @@
 import os
+import gzip
 import struct
+import shutil
+import hashlib
 import numpy as np
 
 """
@@ -8,30 +11,90 @@ Loosely inspired by http://abel.ee.ucla.edu/cvxopt/_downloads/mnist.py
 which is GPL licensed.
 """
 
-def read(dataset = "training", path = "."):
-	"""
-	Python function for importing the MNIST data set.  It returns an iterator
-	of 2-tuples with the first element being the label and the second element
-	being a numpy.uint8 2D array of pixel data for the given image.
-	"""
+# tmpfs mount used for dataset segments shared between processes on the same host
+SHM_DIR = '/dev/shm'
 
-	if dataset is "training":
+def _filenames(dataset, path):
+	'''
+	Returns the paths of the image and label files for the given dataset
+	'''
+	if dataset == "training":
 		fname_img = os.path.join(path, 'train-images-idx3-ubyte')
 		fname_lbl = os.path.join(path, 'train-labels-idx1-ubyte')
-	elif dataset is "testing":
+	elif dataset == "testing":
 		fname_img = os.path.join(path, 't10k-images-idx3-ubyte')
 		fname_lbl = os.path.join(path, 't10k-labels-idx1-ubyte')
 	else:
 		raise ValueError, "dataset must be 'testing' or 'training'"
 
-	# Load everything in some numpy arrays
-	with open(fname_lbl, 'rb') as flbl:
+	# fall back to the downloaded gzip archives when they have not been decompressed
+	if not os.path.exists(fname_img) and os.path.exists(fname_img + '.gz'):
+		fname_img += '.gz'
+	if not os.path.exists(fname_lbl) and os.path.exists(fname_lbl + '.gz'):
+		fname_lbl += '.gz'
+
+	return fname_img, fname_lbl
+
+def _open(fname):
+	'''
+	Opens an IDX file for reading, decompressing on the fly if it is gzipped
+	'''
+	if fname.endswith('.gz'):
+		return gzip.open(fname, 'rb')
+	else:
+		return open(fname, 'rb')
+
+def _read_into(f, out, chunk_size=1 << 20):
+	'''
+	Streams bytes from f into the preallocated (single byte dtype) array out, one chunk at a time
+	'''
+	flat = out.reshape(-1)
+	pos = 0
+	while pos < len(flat):
+		chunk = f.read(min(chunk_size, len(flat) - pos))
+		if not chunk:
+			raise ValueError, "unexpected end of file after %d of %d bytes" % (pos, len(flat))
+		flat[pos:pos + len(chunk)] = np.frombuffer(chunk, dtype=out.dtype)
+		pos += len(chunk)
+
+	return out
+
+def _load(dataset, path, mmap=False):
+	'''
+	Loads the labels and the images (N x rows x cols) of a dataset into numpy arrays.
+	With mmap, the arrays are read-only np.memmap views of the files past their headers,
+	so only the pages that are indexed get read and the page cache is shared between processes.
+	Gzipped files cannot be mapped and are always decompressed into memory.
+	'''
+	fname_img, fname_lbl = _filenames(dataset, path)
+
+	with _open(fname_lbl) as flbl:
 		magic, num = struct.unpack(">II", flbl.read(8))
-		lbl = np.fromfile(flbl, dtype=np.int8)
+		if fname_lbl.endswith('.gz'):
+			lbl = _read_into(flbl, np.empty((num,), dtype=np.int8))
+		elif not mmap:
+			lbl = np.fromfile(flbl, dtype=np.int8)
+		else:
+			lbl = np.memmap(fname_lbl, dtype=np.int8, mode='r', offset=8, shape=(num,))
 
-	with open(fname_img, 'rb') as fimg:
+	with _open(fname_img) as fimg:
 		magic, num, rows, cols = struct.unpack(">IIII", fimg.read(16))
-		img = np.fromfile(fimg, dtype=np.uint8).reshape(len(lbl), rows, cols)
+		if fname_img.endswith('.gz'):
+			img = _read_into(fimg, np.empty((num, rows, cols), dtype=np.uint8))
+		elif not mmap:
+			img = np.fromfile(fimg, dtype=np.uint8).reshape(len(lbl), rows, cols)
+		else:
+			img = np.memmap(fname_img, dtype=np.uint8, mode='r', offset=16, shape=(num, rows, cols))
+
+	return lbl, img
+
+def read(dataset = "training", path = ".", mmap = False):
+	"""
+	Python function for importing the MNIST data set.  It returns an iterator
+	of 2-tuples with the first element being the label and the second element
+	being a numpy.uint8 2D array of pixel data for the given image.
+	"""
+	lbl, img = _load(dataset, path, mmap=mmap)
 
 	get_img = lambda idx: (lbl[idx], img[idx])
 
@@ -39,6 +102,182 @@ def read(dataset = "training", path = "."):
 	for i in xrange(len(lbl)):
 		yield get_img(i)
 
+def _convert(lbl, img, binarize, split, dtype):
+	'''
+	Flattens, binarizes and splits the images as described in read_arrays
+	'''
+	img = img.reshape(len(img), -1)
+
+	if split:
+		half = img.shape[1] / 2
+		parts = (img[:, :half], img[:, half:])
+	else:
+		parts = (img,)
+
+	# astype always copies, so every converted array is contiguous
+	if binarize is not None:
+		parts = tuple((part >= binarize).astype(dtype or np.uint8) for part in parts)
+	elif dtype is not None:
+		parts = tuple(part.astype(dtype) for part in parts)
+
+	if split:
+		return parts
+	elif dtype is None:
+		return lbl, parts[0]
+	else:
+		return lbl.astype(np.int64), parts[0]
+
+def _checksum(fnames):
+	'''
+	md5 of the contents of the given files, read in blocks
+	'''
+	md5 = hashlib.md5()
+	for fname in fnames:
+		with open(fname, 'rb') as f:
+			for block in iter(lambda: f.read(1 << 20), b''):
+				md5.update(block)
+
+	return md5.hexdigest()
+
+def _stamp(fnames):
+	'''
+	Path, size and modification time of the given files, a cheap check for unchanged files
+	'''
+	stamps = []
+	for fname in fnames:
+		st = os.stat(fname)
+		stamps.append('%s:%d:%r' % (os.path.abspath(fname), st.st_size, st.st_mtime))
+
+	return ';'.join(stamps)
+
+def _read_cached(dataset, path, binarize, split, dtype, mmap, cache_dir):
+	'''
+	Binarized arrays are stored bit-packed along the pixel axis, in a file keyed by the threshold
+	and the split layout. The file is rebuilt whenever the checksum of the source IDX files changes,
+	which is only computed when their size or modification time differs from the ones stored with it.
+	'''
+	fnames = _filenames(dataset, path)
+	stamp = _stamp(fnames)
+	layout = 'split' if split else 'full'
+	fname = os.path.join(cache_dir or path, '%s_bin%s_%s.npz' % (dataset, binarize, layout))
+
+	cached = None
+	write = True
+	if os.path.exists(fname):
+		npz = np.load(fname)
+		try:
+			if 'stamp' in npz.files and str(npz['stamp']) == stamp:
+				cached = dict((key, npz[key]) for key in npz.files)
+				write = False
+			elif str(npz['checksum']) == _checksum(fnames):
+				# same contents with a new stamp (copied or touched files), stored again with the new stamp
+				cached = dict((key, npz[key]) for key in npz.files)
+		finally:
+			npz.close()
+
+	if cached is None:
+		arrays = read_arrays(dataset, path, binarize=binarize, split=split, dtype=np.uint8, mmap=mmap)
+		cached = {'checksum': np.array(_checksum(fnames))}
+		if split:
+			parts = arrays
+		else:
+			cached['labels'] = arrays[0]
+			parts = arrays[1:]
+
+		for i, part in enumerate(parts):
+			cached['part%d' % i] = np.packbits(part, axis=1)
+			cached['ncols%d' % i] = np.array(part.shape[1])
+
+	if write:
+		cached['stamp'] = np.array(stamp)
+		# written to a temporary file and renamed, so concurrent runs never see a partial cache
+		try:
+			tmp_fname = '%s.%d.tmp' % (fname, os.getpid())
+			with open(tmp_fname, 'wb') as f:
+				np.savez(f, **cached)
+			os.rename(tmp_fname, fname)
+		except (IOError, OSError) as e:
+			print "Could not write dataset cache %s: %s" % (fname, e)
+
+	parts = tuple(np.unpackbits(cached['part%d' % i], axis=1)[:, :int(cached['ncols%d' % i])].astype(dtype or np.uint8) for i in range(2 if split else 1))
+
+	if split:
+		return parts
+	elif dtype is None:
+		return cached['labels'], parts[0]
+	else:
+		return cached['labels'].astype(np.int64), parts[0]
+
+def _read_shared(dataset, path, binarize, split, dtype, mmap, cache, cache_dir):
+	'''
+	The preprocessed arrays are published once as .npy files in a directory under SHM_DIR, named after
+	the preprocessing options and the path, size and modification time of the source files, so attaching
+	to a published segment does not read them. Every process (including the publisher) gets read-only
+	np.memmap views of that segment, so the dataset is held in memory only once per host.
+	'''
+	key = hashlib.md5(_stamp(_filenames(dataset, path))).hexdigest()
+	layout = 'split' if split else 'full'
+	segment = os.path.join(SHM_DIR, 'mnist_%s_bin%s_%s_%s_%s' % (dataset, binarize, layout, np.dtype(dtype or np.uint8).name, key[:16]))
+	names = ('top', 'bottom') if split else ('labels', 'images')
+
+	if not os.path.isdir(segment):
+		arrays = read_arrays(dataset, path, binarize=binarize, split=split, dtype=dtype, mmap=mmap, cache=cache, cache_dir=cache_dir)
+
+		# published under a temporary name and renamed, so attaching processes never see a partial segment
+		tmp_segment = '%s.%d.tmp' % (segment, os.getpid())
+		os.mkdir(tmp_segment)
+		for name, array in zip(names, arrays):
+			np.save(os.path.join(tmp_segment, name + '.npy'), array)
+		try:
+			os.rename(tmp_segment, segment)
+		except OSError:
+			# another process published the same segment in the meantime
+			shutil.rmtree(tmp_segment)
+
+	return tuple(np.load(os.path.join(segment, name + '.npy'), mmap_mode='r') for name in names)
+
+def read_arrays(dataset = "training", path = ".", binarize = None, split = False, dtype = np.float32, mmap = False, cache = False, cache_dir = None, shared = False):
+	"""
+	Bulk version of read. Images are flattened in row major order and returned
+	as a single N x (rows*cols) array of the given dtype.
+
+	binarize: threshold, pixels >= binarize become 1 and the rest 0 (None keeps raw intensities)
+	split: if True, returns (top, bottom) halves of the images instead of (labels, images)
+	mmap: read the files through np.memmap. Together with binarize=None and dtype=None,
+		  the returned arrays are zero-copy uint8 views of the files.
+	cache: keep the binarized arrays bit-packed on disk in cache_dir (defaults to path),
+		   invalidated by a checksum of the IDX files. Requires binarize.
+	shared: publish the returned arrays once per host in shared memory (SHM_DIR) and return
+			read-only views of it. Segments are not removed automatically.
+	"""
+	if shared:
+		return _read_shared(dataset, path, binarize, split, dtype, mmap, cache, cache_dir)
+
+	if cache:
+		if binarize is None:
+			raise ValueError, "only binarized datasets can be cached"
+		return _read_cached(dataset, path, binarize, split, dtype, mmap, cache_dir)
+
+	lbl, img = _load(dataset, path, mmap=mmap)
+	return _convert(lbl, img, binarize, split, dtype)
+
+def read_chunks(dataset = "training", path = ".", chunk_size = 10000, binarize = None, split = False, dtype = np.float32):
+	"""
+	Streaming version of read_arrays for datasets that do not fit in memory. The files are
+	read sequentially and the converted arrays are yielded chunk_size images at a time.
+	"""
+	fname_img, fname_lbl = _filenames(dataset, path)
+
+	with _open(fname_lbl) as flbl, _open(fname_img) as fimg:
+		magic, num = struct.unpack(">II", flbl.read(8))
+		magic, num, rows, cols = struct.unpack(">IIII", fimg.read(16))
+
+		for start in xrange(0, num, chunk_size):
+			size = min(chunk_size, num - start)
+			lbl = _read_into(flbl, np.empty((size,), dtype=np.int8))
+			img = _read_into(fimg, np.empty((size, rows, cols), dtype=np.uint8))
+			yield _convert(lbl, img, binarize, split, dtype)
+
 def show(image):
 	"""
 	Render a given numpy.uint8 2D array of pixel data.
@@ -51,4 +290,4 @@ def show(image):
 	imgplot.set_interpolation('nearest')
 	ax.xaxis.set_ticks_position('top')
 	ax.yaxis.set_ticks_position('left')
-	pyplot.show()
\ No newline at end of file
+	pyplot.show()
@@ -1,14 +1,23 @@
 import sys
+import os
 
 import numpy as np
-from read_mnist import read, show
+from read_mnist import read_arrays, show
 import theano
 import theano.tensor as T
-from utils import init_weights, _concat
+from theano.ifelse import ifelse
+from utils import init_weights, _concat, PhaseTimer, gated_updates
 import argparse
 
-from adam import adam
+from adam import adam, adam_updates
 from sgd import SGD
+from batches import BatchIterator
+from metrics import MetricsLogger
+from checkpoint import CheckpointWriter
+from trainstate import state_variables, capture, load, restore, StopRequest
+from fncache import cache_file, save_functions, load_functions
+from evaluation import evaluate
+from parallel import AsyncTrainer
 
 from collections import OrderedDict
 import time
@@ -87,6 +96,28 @@ parser.add_argument('-e', '--random_seed', type=int, default=42, help='Seed to i
 parser.add_argument('-o', '--latent_type', type=str, default='disc', help='No other options')
 parser.add_argument('-p', '--clip_probs', type=int, default=0,
 					help='clip latent probabilities (1) or not (0), useful for testing training under NaNs')
+parser.add_argument('-ah', '--shared_data', type=int, default=0,
+					help='Attach to the preprocessed dataset in shared memory, publishing it if needed (1), or keep a private copy (0)')
+parser.add_argument('-ai', '--device_perm', type=int, default=0,
+					help='Keep the epoch permutation in a shared variable so that each step only takes the batch number (1) or pass the image ids every step (0)')
+parser.add_argument('-aj', '--resume', type=int, default=0,
+					help='Continue from the training state saved for this configuration, if there is one (1) or start from scratch (0)')
+parser.add_argument('-ak', '--compile_cache', type=int, default=0,
+					help='Reuse the compiled training functions of an earlier run with the same graph, storing them after compiling in <compiledir>/functions (1) or always compile (0)')
+parser.add_argument('-al', '--val_freq', type=int, default=0,
+					help='Evaluate the test set with the current weights every this many epochs while training, 0 disables it')
+parser.add_argument('-am', '--num_samples', type=int, default=1,
+					help='Number of latent samples per test image, the loss of an image is averaged over them')
+parser.add_argument('-an', '--eval_chunk', type=int, default=1000,
+					help='Number of test images evaluated per call')
+parser.add_argument('-ao', '--fused_step', type=int, default=0,
+					help='Update the main network and the subnetwork in a single compiled call, keeping the subnetwork inputs on the device (1) or in separate calls through the host (0)')
+parser.add_argument('-ap', '--async_sg', type=int, default=0,
+					help='Train the subnetwork in a separate process, without the main network waiting for it (1) or after every main network step (0)')
+parser.add_argument('-aq', '--sg_queue', type=int, default=4,
+					help='Subnetwork steps queued for the asynchronous trainer, the inputs of later steps are dropped while it is full')
+parser.add_argument('-ar', '--sg_publish_freq', type=int, default=10,
+					help='Number of subnetwork steps after which the asynchronous trainer hands its weights to the main network')
 
 args = parser.parse_args()
 
@@ -104,16 +135,6 @@ init_rate = args.learning_rate
 delta = 1e-7
 # ---------------------------------------------------------------------------------------------------------------------------------------------------------
 
-# converts images into binary images for simplicity
-def binarize_img(img):
-	return np.asarray(img >= 100, dtype=np.int8)
-
-# split into two images
-def split_img(img):
-	# images are flattened into a vector: just need to split into half
-	veclen = len(img)
-	return (img[:veclen/2], img[veclen/2:])
-
 def param_init_fflayer(params, prefix, nin, nout, zero_init=False, batchnorm=False, skip_running_vars=False, scale=0.1):
 	'''
 	Initializes weights for a feedforward layer
@@ -276,18 +297,49 @@ def synth_grad(tparams, prefix, inp, mode='Train'):
 
 		# channel 1 + channel 2
 		return fflayer(tparams, out2, _concat(prefix, '2'), nonlin=None) + inp
-# ---------------------------------------------------------------------------------------------------------------------------------------------------------
 
-print "Creating partial images"
-# collect training data and converts image into binary and does row major flattening
-trc = np.asarray([binarize_img(img).flatten() for lbl, img in read(dataset='training', path ='MNIST/')], dtype=np.float32)
+def per_sample(x):
+	'''
+	Repeats the rows of a per image matrix for the args.repeat latent samples of every image. Only the inputs of the
+	synthetic gradient subnetwork need them, the losses broadcast the per image terms over the samples instead.
+	'''
+	global args
+	return T.extra_ops.repeat(x, args.repeat, axis=0)
+
+def test_losses(tparams, img, gt, num_samples=1):
+	'''
+	Test mode loss of every image (batchnorm with running averages), averaged over num_samples latent samples.
+	The encoder runs once, the samples of all images are drawn and decoded in a single batch of num_samples * len(img) rows.
+	'''
+	global srng, args
 
-# collect test data and converts image into binary and does row major flattening
-tec = np.asarray([binarize_img(img).flatten() for lbl, img in read(dataset='testing', path = 'MNIST/')], dtype=np.float32)
+	out1 = fflayer(tparams, img, _concat(ff_e, 'i'), batchnorm='test')
+	out2 = fflayer(tparams, out1, _concat(ff_e, 'h'), batchnorm='test')
 
-# split images
-trp = [split_img(img) for img in trc]
-tep = [split_img(img) for img in tec]
+	if args.bn_type == 0:
+		latent_probs = T.nnet.nnet.sigmoid(fflayer(tparams, out2, _concat(ff_e, 'bern'), nonlin=None, batchnorm='test'))
+	else:
+		latent_probs = T.nnet.nnet.sigmoid(fflayer(tparams, out2, _concat(ff_e, 'bern'), nonlin=None, batchnorm=None))
+	if args.clip_probs:
+		latent_probs = T.clip(latent_probs, delta, 1. - delta)
+
+	# latent samples are drawn with shape (num_samples, images, latent_dim)
+	shape = (num_samples, latent_probs.shape[0], latent_probs.shape[1])
+	latent_samples = srng.binomial(size=shape, n=1, p=latent_probs.dimshuffle('x', 0, 1), dtype=theano.config.floatX)
+
+	outz = fflayer(tparams, latent_samples.reshape((shape[0] * shape[1], shape[2])), _concat(ff_d, 'n'))
+	outh = fflayer(tparams, outz, _concat(ff_d, 'h'), batchnorm='test')
+	if args.bn_type == 0:
+		probs = fflayer(tparams, outh, _concat(ff_d, 'o'), nonlin='sigmoid', batchnorm='test')
+	else:
+		probs = fflayer(tparams, outh, _concat(ff_d, 'o'), nonlin='sigmoid', batchnorm=None)
+
+	losses = T.nnet.binary_crossentropy(probs.reshape((shape[0], shape[1], probs.shape[1])), gt.dimshuffle('x', 0, 1))
+	return losses.mean(axis=2).mean(axis=0)
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------
+
+# time spent in each phase before training starts
+startup = PhaseTimer()
 
 print "Initializing parameters"
 # parameter initializations
@@ -334,28 +386,34 @@ if args.load is not None:
 tparams = OrderedDict()
 for key, val in params.iteritems():
 	tparams[key] = theano.shared(val, name=key)
+startup.mark('parameter init')
 # ---------------------------------------------------------------------------------------------------------------------------------------------------------
 
 # Training graph
 if args.mode == 'train':
-	print "Constructing graph for training"
-	
-	# create shared variables for dataset for easier access
-	if args.mode == 'train':
-		top = np.asarray([splitimg[0] for splitimg in trp], dtype=np.float32)
-		bot = np.asarray([splitimg[1] for splitimg in trp], dtype=np.float32)
+	print "Creating partial images"
+	# binarized training images, flattened in row major order and split into top and bottom halves
+	top, bot = read_arrays(dataset='training', path='MNIST/', binarize=100, split=True, cache=True, shared=args.shared_data)
+	startup.mark('data load')
 
-	train = theano.shared(top, name='train')
-	train_gt = theano.shared(bot, name='train_gt')
+	print "Constructing graph for training"
+	# create shared variables for dataset for easier access, borrowed so that the arrays are not copied again
+	train = theano.shared(top, name='train', borrow=True)
+	train_gt = theano.shared(bot, name='train_gt', borrow=True)
 
 	# pass a batch of indices while training
-	img_ids = T.vector('ids', dtype='int64')
-	img = train[img_ids,:]
-	img_r = T.extra_ops.repeat(img, args.repeat, axis=0)
+	if args.device_perm:
+		# the permutation is uploaded once per epoch and the batch is sliced out of it inside the graph
+		perm = theano.shared(np.arange(len(top), dtype=np.int64), name='perm')
+		batch_num = T.scalar('batch', dtype='int64')
+		img_ids = perm[batch_num * args.batch_size:(batch_num + 1) * args.batch_size]
+		inps_data = [batch_num]
+	else:
+		img_ids = T.vector('ids', dtype='int64')
+		inps_data = [img_ids]
 
-	# repeat args.repeat-times to compensate for the sampling process
-	gt_unrepeated = train_gt[img_ids,:]
-	gt = T.extra_ops.repeat(gt_unrepeated, args.repeat, axis=0)
+	img = train[img_ids,:]
+	gt = train_gt[img_ids,:]
 
 	# inputs for synthetic gradient networks: needs the top half of the image batch
 	target_gradients = T.matrix('tg', dtype='float32')
@@ -367,13 +425,16 @@ if args.mode == 'train':
 
 # Test graph
 else:
+	print "Creating partial images"
+	# binarized test images, flattened in row major order and split into top and bottom halves
+	# read from the bit-packed cache
+	top, bot = read_arrays(dataset='testing', path='MNIST/', binarize=100, split=True, cache=True, shared=args.shared_data)
+	startup.mark('data load')
+
 	print "Constructing the test graph"
-	# create shared variables for dataset for easier access
-	top = np.asarray([splitimg[0] for splitimg in tep], dtype=np.float32)
-	bot = np.asarray([splitimg[1] for splitimg in tep], dtype=np.float32)
-	
-	test = theano.shared(top, name='test')
-	test_gt = theano.shared(bot, name='test_gt')
+	# create shared variables for dataset for easier access, borrowed so that the arrays are not copied again
+	test = theano.shared(top, name='test', borrow=True)
+	test_gt = theano.shared(bot, name='test_gt', borrow=True)
 
 	# image ids
 	img_ids = T.vector('ids', dtype='int64')
@@ -389,7 +450,7 @@ if args.bn_type == 0:
 else:
 	pre_out3 = fflayer(tparams, out2, _concat(ff_e, 'bern'), nonlin=None, batchnorm=None)
 
-out3 = T.nnet.nnet.sigmoid(T.extra_ops.repeat(pre_out3, args.repeat, axis=0))
+out3 = T.nnet.nnet.sigmoid(pre_out3)
 
 if args.clip_probs == 0:
 	latent_probs = out3
@@ -398,17 +459,24 @@ else:
 
 latent_probs_c = 1. - latent_probs
 
+# args.repeat latent samples per image, in (batch, repeat, latent) layout: the probabilities are broadcast over the samples
+latent_probs_r = latent_probs.dimshuffle(0, 'x', 1)
+samples_shape = (latent_probs.shape[0], args.repeat, latent_probs.shape[1])
+
 if args.mode == 'test' or args.target == 'REINFORCE':
 	# sample a bernoulli distribution, which a binomial of 1 iteration
-	latent_samples = srng.binomial(size=latent_probs.shape, n=1, p=latent_probs, dtype=theano.config.floatX)
+	latent_samples_r = srng.binomial(size=samples_shape, n=1, p=latent_probs_r, dtype=theano.config.floatX)
 
 elif args.target == 'ST':
 	# sample a bernoulli distribution, which a binomial of 1 iteration
-	latent_samples_uncorrected = srng.binomial(size=latent_probs.shape, n=1, p=latent_probs, dtype=theano.config.floatX)
+	latent_samples_uncorrected = srng.binomial(size=samples_shape, n=1, p=latent_probs_r, dtype=theano.config.floatX)
 	
 	# for stop gradients trick
-	dummy = latent_samples_uncorrected - latent_probs
-	latent_samples = latent_probs + dummy
+	dummy = latent_samples_uncorrected - latent_probs_r
+	latent_samples_r = latent_probs_r + dummy
+
+# the decoder takes one row per sample
+latent_samples = latent_samples_r.reshape((samples_shape[0] * samples_shape[1], samples_shape[2]))
 
 # decoding
 outz = fflayer(tparams, latent_samples, _concat(ff_d, 'n'))
@@ -421,8 +489,10 @@ else:
 
 # Training
 if args.mode == 'train':
+	startup.mark('graph build')
 	# --------------------Gradients for main network----------------------------------------------------------------------------
-	reconstruction_loss = T.nnet.binary_crossentropy(probs, gt).mean(axis=1)
+	# one row per image and one column per latent sample
+	reconstruction_loss = T.nnet.binary_crossentropy(probs.reshape((gt.shape[0], args.repeat, gt.shape[1])), gt.dimshuffle(0, 'x', 1)).mean(axis=2)
 	print "Computing synthetic gradients"
 
 	# separate parameters for encoder, decoder and sg subnetworks
@@ -450,25 +520,27 @@ if args.mode == 'train':
 	if args.target == 'REINFORCE':
 		print "Getting REINFORCE target"
 		# arguments to be considered constant when computing gradients
-		consider_constant = [reconstruction_loss, latent_samples]
+		consider_constant = [reconstruction_loss, latent_samples_r]
+		# log probabilities of the samples, the logs are only taken once per image and latent unit
+		log_probs = T.switch(latent_samples_r, T.log(latent_probs_r), T.log(1. - latent_probs_r)).sum(axis=2)
 
 		if args.var_red is None:
-			cost_encoder = T.mean(reconstruction_loss * T.switch(latent_samples, T.log(latent_probs), T.log(1. - latent_probs)).sum(axis=1))
+			cost_encoder = T.mean(reconstruction_loss * log_probs)
 
 		elif args.var_red == 'mr':
 			# unconditional mean is subtracted from the reconstruction loss, to yield a relatively lower variance unbiased REINFORCE estimator
-			cost_encoder = T.mean((reconstruction_loss - T.mean(reconstruction_loss)) * T.switch(latent_samples, T.log(latent_probs), T.log(1. - latent_probs)).sum(axis=1))
+			cost_encoder = T.mean((reconstruction_loss - T.mean(reconstruction_loss)) * log_probs)
 			
 		elif args.var_red == 'cmr':
-			# conditional mean is subtracted from the reconstruction loss to lower variance further
-			baseline = T.extra_ops.repeat(fflayer(tparams, T.concatenate([img, gt_unrepeated], axis=1), 'loss_pred', nonlin='relu'), args.repeat, axis=0)
+			# conditional mean is subtracted from the reconstruction loss to lower variance further, one prediction per image
+			baseline = T.addbroadcast(fflayer(tparams, T.concatenate([img, gt], axis=1), 'loss_pred', nonlin='relu'), 1)
 			
 			if args.use_exp_reward:
-				cost_encoder = T.mean(-(T.exp(-reconstruction_loss / args.exptemp) - baseline.T) * T.switch(latent_samples, T.log(latent_probs), T.log(1. - latent_probs)).sum(axis=1))
-				cost_pred = T.mean((T.exp(-reconstruction_loss / args.exptemp) - baseline.T) ** 2)
+				cost_encoder = T.mean(-(T.exp(-reconstruction_loss / args.exptemp) - baseline) * log_probs)
+				cost_pred = T.mean((T.exp(-reconstruction_loss / args.exptemp) - baseline) ** 2)
 			else:
-				cost_encoder = T.mean((reconstruction_loss - baseline.T) * T.switch(latent_samples, T.log(latent_probs), T.log(1. - latent_probs)).sum(axis=1))
-				cost_pred = T.mean((reconstruction_loss - baseline.T) ** 2)
+				cost_encoder = T.mean((reconstruction_loss - baseline) * log_probs)
+				cost_pred = T.mean((reconstruction_loss - baseline) ** 2)
 
 			params_loss_predictor = [val for key, val in tparams.iteritems() if 'loss_pred' in key]
 			print "Loss predictor parameters:", params_loss_predictor
@@ -485,7 +557,8 @@ if args.mode == 'train':
 		sg_target = T.grad(cost_decoder, wrt=pre_out3, consider_constant=[dummy])
 
 	print "Computing gradients wrt to encoder parameters"
-	var_list = [img_r, gt, latent_probs, gradz, latent_samples, baseline, latent_probs_c]
+	# gradz and the samples have a row per sample, the per image inputs are repeated for them
+	var_list = [per_sample(img), per_sample(gt), per_sample(latent_probs), gradz, latent_samples, per_sample(baseline), per_sample(latent_probs_c)]
 	sg_cond_vars_actual = [var_list[i] for i in range(7) if args.sg_inp[i] == '1']
 
 	known_grads = OrderedDict()
@@ -508,18 +581,27 @@ if args.mode == 'train':
 
 	# target_gradients_normalized = args.max_grad * target_gradients * (T.inv(T.sqrt((target_gradients ** 2).sum(axis=1) + delta)).dimshuffle(0, 'x'))
 	
-	var_list = [img_r, gt, activation, latent_gradients, samples, extra1, extra2]
+	# the probabilities and the baseline are given per image, as output by f_grad_shared
+	var_list = [per_sample(img), per_sample(gt), per_sample(activation), latent_gradients, samples, per_sample(extra1), per_sample(extra2)]
 	sg_cond_vars_symbol = [var_list[i] for i in range(7) if args.sg_inp[i] == '1']
 	
 	loss_sg = T.mean((target_gradients_normalized - synth_grad(tparams, _concat(sg, 'r'), T.concatenate(sg_cond_vars_symbol, axis=1)).reshape((args.batch_size, args.repeat, latent_dim)).sum(axis=1) / args.repeat) ** 2)
 	grads_sg = T.grad(loss_sg + args.sg_reg * weights_sum_sg, wrt=param_sg)
+	startup.mark('gradients')
 	# ----------------------------------------------General training routine------------------------------------------------------
 	
-	lr = T.scalar('lr', dtype='float32')
+	if args.fused_step:
+		# the compiled step also applies the update, the learning rate is held in a shared variable instead
+		lr = theano.shared(np.float32(args.learning_rate), name='main_lr')
+		# update frequencies, checked on the device by the fused step
+		main_freq = theano.shared(np.int64(args.main_update_freq), name='main_freq')
+		sub_freq = theano.shared(np.int64(args.sub_update_freq), name='sub_freq')
+	else:
+		lr = T.scalar('lr', dtype='float32')
 	cost = cost_decoder
 
-	inps_net = [img_ids]
-	inps_sg = inps_net + [target_gradients] + var_list[2:]
+	inps_net = list(inps_data)
+	inps_sg = inps_net + [target_gradients, activation, latent_gradients, samples, extra1, extra2]
 	tparams_net = OrderedDict() # All parameters for the main network
 	tparams_dec = OrderedDict() # Decoder and loss prediction network parameters
 	tparams_enc = OrderedDict() # Encoder parameters
@@ -550,23 +632,178 @@ if args.mode == 'train':
 			else:
 				tparams_dec[key] = val
 
+	if args.val_freq > 0:
+		print "Constructing graph for validation"
+		# the test set is evaluated in test mode on the parameters being trained
+		val_top, val_bot = read_arrays(dataset='testing', path='MNIST/', binarize=100, split=True, cache=True, shared=args.shared_data)
+		startup.mark('data load')
+		val = theano.shared(val_top, name='val', borrow=True)
+		val_gt = theano.shared(val_bot, name='val_gt', borrow=True)
+		val_ids = T.vector('val_ids', dtype='int64')
+		val_losses = test_losses(tparams, val[val_ids,:], val_gt[val_ids,:], args.num_samples)
+		startup.mark('graph build')
+
+	if args.async_sg and (args.fused_step or args.device_perm):
+		raise ValueError, "The asynchronous subnetwork trainer takes the image ids and the subnetwork inputs from the host, use --fused_step 0 --device_perm 0"
+	if args.async_sg and theano.config.device != 'cpu':
+		# the forked trainer cannot use the device context of its parent
+		raise ValueError, "The asynchronous subnetwork trainer runs in a forked process and is CPU only, use device=cpu"
+
 	print "Setting up optimizers"
-	f_grad_shared, f_update = adam(lr, tparams_net, grads_net, inps_net, [cost, sg_target, latent_probs, gradz, latent_samples, baseline, latent_probs_c], ups=updates_bn)
-	# f_grad_shared_sg, f_update_sg = adam(lr, tparams_sg, grads_sg, inps_sg, [loss_sg, tgnorm, target_gradients_normalized])
-	# f_grad_shared_dec, f_update_dec = adam(lr, tparams_dec, grads_decoder, inps_net, [cost, sg_target, latent_probs, gradz, latent_samples], ups=updates_bn_dec)
-	# f_grad_shared_enc, f_update_enc = adam(lr, tparams_enc, grads_encoder, inps_net, [T.mean(known_grads[pre_out3] ** 2)], ups=updates_bn_enc)
-	
-	# sgd with momentum updates
 	sgd = SGD(lr=args.sg_learning_rate)
-	sgd_update_sg = theano.function(inps_sg, loss_sg, updates=sgd.get_grad_updates(loss_sg, param_sg), on_unused_input='ignore', profile=False)
 
-	print "Training"
-	cost_report = open('./Results/' + args.latent_type + '/' + estimator + '/tsgd_' + code_name + '_' + str(args.batch_size) + '_' + str(args.learning_rate) + '.txt', 'w')
-	id_order = range(len(trc))
+	# shared variables set by this script, cached functions come with their own copies which take these values
+	script_shared = OrderedDict((key, val) for key, val in tparams.iteritems() if isinstance(val, theano.compile.SharedVariable))
+	script_shared['train'] = train
+	script_shared['train_gt'] = train_gt
+	if args.device_perm:
+		script_shared['perm'] = perm
+	script_shared['lr'] = sgd.lr
+	script_shared['momentum'] = sgd.momentum
+	if args.fused_step:
+		script_shared['main_lr'] = lr
+		script_shared['main_freq'] = main_freq
+		script_shared['sub_freq'] = sub_freq
+	if args.val_freq > 0:
+		script_shared['val'] = val
+		script_shared['val_gt'] = val_gt
+
+	functions = None
+	if args.compile_cache:
+		# arguments that leave the compiled graph unchanged
+		run_args = ['learning_rate', 'sg_learning_rate', 'slash_rate', 'sg_slash_rate', 'epoch_rate', 'sg_epoch_rate', 'main_update_freq', 'sub_update_freq', 'update_style',
+					'term_condition', 'num_epochs', 'min_cost', 'save_freq', 'base_code', 'load', 'val_file', 'shared_data', 'resume', 'compile_cache', 'val_freq', 'eval_chunk',
+					'async_sg', 'sg_queue', 'sg_publish_freq']
+		graph_args = dict((k, v) for k, v in vars(args).iteritems() if k not in run_args)
+		graph_args['validation'] = args.val_freq > 0
+		if args.val_freq == 0:
+			del graph_args['num_samples']
+		functions_file = cache_file('stochasticdni', graph_args)
+		functions, replaced = load_functions(functions_file, script_shared)
+
+	if functions is None and args.fused_step:
+		functions = OrderedDict()
+		# the subnetwork is trained on the intermediates of the same step, which stay in the graph: they are
+		# constants of its loss, as the inputs of sgd_update_sg are
+		intermediates = [sg_target, latent_probs, gradz, latent_samples, T.unbroadcast(baseline, 1), latent_probs_c]
+		loss_sg_step = theano.clone(loss_sg, replace=zip([target_gradients, activation, latent_gradients, samples, extra1, extra2], [theano.gradient.disconnected_grad(x) for x in intermediates]))
+
+		# steps are counted on the device, the updates of a network are skipped (not computed) between its update steps
+		# and the subnetwork is not updated on a target with NaNs
+		step = theano.shared(np.int64(0), name='fused_step_count')
+		step_t = step + 1
+		target_nan = T.isnan(T.mean(sg_target ** 2))
+		update_main = T.eq(step_t % main_freq, 0)
+		update_sub = T.and_(T.eq(step_t % sub_freq, 0), T.eq(target_nan, 0))
+
+		updates = gated_updates(update_main, adam_updates(lr, tparams_net, grads_net)) + updates_bn
+		updates += gated_updates(update_sub, sgd.get_grad_updates(loss_sg_step, param_sg)) + [(step, step_t)]
+		# the subnetwork cost is NaN on steps without its update
+		cost_sg_step = ifelse(update_sub, loss_sg_step, T.constant(np.float32(np.nan)))
+		functions['f_step'] = theano.function(inps_net, [cost, cost_sg_step, target_nan], updates=updates, on_unused_input='ignore', profile=False)
+		if args.val_freq > 0:
+			functions['f_val'] = theano.function([val_ids], val_losses)
+
+		if args.compile_cache:
+			save_functions(functions_file, functions, script_shared)
+	elif functions is None:
+		functions = OrderedDict()
+		functions['f_grad_shared'], functions['f_update'] = adam(lr, tparams_net, grads_net, inps_net, [cost, sg_target, latent_probs, gradz, latent_samples, baseline, latent_probs_c], ups=updates_bn)
+		# f_grad_shared_sg, f_update_sg = adam(lr, tparams_sg, grads_sg, inps_sg, [loss_sg, tgnorm, target_gradients_normalized])
+		# f_grad_shared_dec, f_update_dec = adam(lr, tparams_dec, grads_decoder, inps_net, [cost, sg_target, latent_probs, gradz, latent_samples], ups=updates_bn_dec)
+		# f_grad_shared_enc, f_update_enc = adam(lr, tparams_enc, grads_encoder, inps_net, [T.mean(known_grads[pre_out3] ** 2)], ups=updates_bn_enc)
+		
+		# sgd with momentum updates
+		functions['sgd_update_sg'] = theano.function(inps_sg, loss_sg, updates=sgd.get_grad_updates(loss_sg, param_sg), on_unused_input='ignore', profile=False)
+		if args.val_freq > 0:
+			functions['f_val'] = theano.function([val_ids], val_losses)
 
-	iters = 0
-	min_cost = 100000.0
-	epoch = 0
+		if args.compile_cache:
+			save_functions(functions_file, functions, script_shared)
+	else:
+		print "Loaded the compiled functions from " + functions_file
+		for key in tparams:
+			if key in replaced:
+				tparams[key] = replaced[key]
+		if 'perm' in replaced:
+			perm = replaced['perm']
+		sgd.lr = replaced.get('lr', sgd.lr)
+		sgd.momentum = replaced.get('momentum', sgd.momentum)
+		if args.fused_step:
+			lr = replaced.get('main_lr', lr)
+			main_freq = replaced.get('main_freq', main_freq)
+			sub_freq = replaced.get('sub_freq', sub_freq)
+
+	if args.fused_step:
+		f_step = functions['f_step']
+		training_functions = [f_step]
+	else:
+		f_grad_shared = functions['f_grad_shared']
+		f_update = functions['f_update']
+		sgd_update_sg = functions['sgd_update_sg']
+		training_functions = [f_grad_shared, f_update, sgd_update_sg]
+	f_val = functions.get('f_val')
+	startup.mark('compile')
+	startup.report()
+
+	print "Training"
+	# everything needed to continue the run exactly: shared variables updated by training (parameters,
+	# optimizer and batchnorm state, random streams), loop counters, schedules and the random state of the minibatches
+	state_vars = state_variables(training_functions)
+	state_file = './Results/' + args.latent_type + '/' + estimator + '/tsgd_' + code_name + '_' + str(args.batch_size) + '_' + str(init_rate) + '.state'
+	loop = {'epoch': 0, 'batch': 0, 'iters': 0, 'min_cost': 100000.0, 'epoch_cost': 0., 'epoch_cost_sg': 0., 'learning_rate': args.learning_rate,
+			'sg_learning_rate': args.sg_learning_rate, 'sub_update_freq': args.sub_update_freq, 'metrics_offset': None, 'val_offset': None}
+	if args.resume and os.path.exists(state_file):
+		loop, rng_state = restore(state_vars, load(state_file))
+		args.learning_rate = loop['learning_rate']
+		args.sg_learning_rate = loop['sg_learning_rate']
+		sgd.lr.set_value(args.sg_learning_rate)
+		args.sub_update_freq = loop['sub_update_freq']
+		print "Resuming from epoch " + str(loop['epoch'] + 1) + ", batch " + str(loop['batch'])
+	if args.fused_step:
+		lr.set_value(np.float32(args.learning_rate))
+		main_freq.set_value(np.int64(args.main_update_freq))
+		sub_freq.set_value(np.int64(args.sub_update_freq))
+
+	if args.async_sg:
+		# the subnetwork is trained in a forked process on the inputs of the main network steps. The main network uses the
+		# subnetwork weights published last, which come with the momentum of the trainer for the checkpoints.
+		sg_trainer = AsyncTrainer(state_variables([sgd_update_sg]), sgd_update_sg, args.sg_queue, args.sg_publish_freq, controls=[sgd.lr])
+		sg_trainer.start()
+		# sum of the costs of the trainer counted in the epoch costs so far
+		sg_total = 0.
+
+	# shuffled minibatches are prepared by a background thread while the compiled functions run, started after the
+	# trainer is forked so that no thread holds a lock in the fork
+	batches = BatchIterator(len(top), args.batch_size)
+	if args.resume and os.path.exists(state_file):
+		batches.restart(rng_state)
+
+	# binary records, buffered in memory and written by a background thread
+	cost_report = MetricsLogger('./Results/' + args.latent_type + '/' + estimator + '/tsgd_' + code_name + '_' + str(args.batch_size) + '_' + str(init_rate) + '.bin', ['epoch', 'batch', 'cost', 'cost_sg', 'time'], batch_size=args.batch_size, steps_per_epoch=batches.num_batches, offset=loop['metrics_offset'])
+	if args.val_freq > 0:
+		val_report = MetricsLogger('./Results/' + args.latent_type + '/' + estimator + '/validation_' + code_name + '_' + str(args.batch_size) + '_' + str(init_rate) + '.bin', ['epoch', 'loss', 'stderr', 'time'], offset=loop.get('val_offset'))
+	# checkpoints are written by a background thread
+	checkpoints = CheckpointWriter()
+	# SIGTERM stops training after the current step, with the training state written out
+	stop = StopRequest()
+
+	def save_state(epoch, first_batch, epoch_cost, epoch_cost_sg, rng_state):
+		cost_report.flush()
+		loop = {'epoch': epoch, 'batch': first_batch, 'iters': iters, 'min_cost': min_cost, 'epoch_cost': epoch_cost, 'epoch_cost_sg': epoch_cost_sg,
+				'learning_rate': args.learning_rate, 'sg_learning_rate': args.sg_learning_rate, 'sub_update_freq': args.sub_update_freq,
+				'metrics_offset': cost_report.offset, 'val_offset': None}
+		if args.val_freq > 0:
+			loop['val_offset'] = val_report.offset
+		checkpoints.save_state(state_file, capture(state_vars, loop, rng_state))
+
+	iters = loop['iters']
+	min_cost = loop['min_cost']
+	epoch = loop['epoch']
+	epoch_cost = loop['epoch_cost']
+	epoch_cost_sg = loop['epoch_cost_sg']
+	# batches of the current epoch that were done before resuming
+	first_batch = loop['batch']
 	condition = False
 	
 	# reinitialization scheme for channel 1 of custom subnetwork
@@ -581,46 +818,80 @@ if args.mode == 'train':
 	# reinit = theano.function([gam, bet, w1, w2, b1, b2], None, updates=reinit_dict)
 
 	while condition == False:
-		# learning rate schedule for subnetwork
-		if iters != 0 and iters % (args.sg_epoch_rate * 600) == 0 and args.sg_learning_rate > 1e-6:
-			args.sg_learning_rate /= args.sg_slash_rate
-			print "Updated subnetwork learning rate:", args.sg_learning_rate
-			sgd.lr.set_value(args.sg_learning_rate)
-
-		# learning rate schedule for the main network
-		if iters != 0 and iters % (args.epoch_rate * 600) == 0 and args.learning_rate > 1e-7:
-			args.learning_rate /= args.slash_rate
-			print "Updated main network learning rate:", args.learning_rate
+		# a resumed epoch continues with its learning rates and costs
+		if first_batch == 0:
+			# learning rate schedule for subnetwork
+			if iters != 0 and iters % (args.sg_epoch_rate * 600) == 0 and args.sg_learning_rate > 1e-6:
+				args.sg_learning_rate /= args.sg_slash_rate
+				print "Updated subnetwork learning rate:", args.sg_learning_rate
+				if args.async_sg:
+					sg_trainer.set_value(sgd.lr, np.float32(args.sg_learning_rate))
+				else:
+					sgd.lr.set_value(args.sg_learning_rate)
+
+			# learning rate schedule for the main network
+			if iters != 0 and iters % (args.epoch_rate * 600) == 0 and args.learning_rate > 1e-7:
+				args.learning_rate /= args.slash_rate
+				print "Updated main network learning rate:", args.learning_rate
+				if args.fused_step:
+					lr.set_value(np.float32(args.learning_rate))
+
+			epoch_cost = 0.
+			epoch_cost_sg = 0.
 			
 		print "Epoch " + str(epoch + 1),
-		np.random.shuffle(id_order)
-		epoch_cost = 0.
-		epoch_cost_sg = 0.
 		epoch_start = time.time()
-		for batch_id in range(len(trc)/args.batch_size):
+		for batch_id, idlist in enumerate(batches.epoch(skip=first_batch), first_batch):
 			batch_start = time.time()
 			iters += 1
 
-			idlist = id_order[batch_id*args.batch_size:(batch_id+1)*args.batch_size]
-			
-			# main network update
-			outs = f_grad_shared(idlist)
-			cost, t = outs[:2]
-			if iters % args.main_update_freq == 0:
-				f_update(args.learning_rate)
-			
-			# subnetwork update
-			cost_sg = 'NC'
-			tmag = 'NC'
-			if iters % args.sub_update_freq == 0 and not np.isnan((t**2).mean()):
-				cost_sg = sgd_update_sg(idlist, *outs[1:])
-				# f_update_sg(args.sg_learning_rate)
-				epoch_cost_sg += cost_sg
-			
-			elif np.isnan((t**2).mean()):
-				print "NaN encountered at", iters
+			# the compiled functions take the batch number instead of the image ids
+			if args.device_perm:
+				if batch_id == first_batch:
+					perm.set_value(batches.permutation, borrow=True)
+				idlist = batch_id
+
+			if args.fused_step:
+				# both updates in one call, the subnetwork cost is NaN when its update was skipped
+				cost, cost_sg, target_nan = f_step(idlist)
+				if not np.isnan(cost_sg):
+					epoch_cost_sg += cost_sg
+				elif target_nan:
+					print "NaN encountered at", iters
+			else:
+				# main network update
+				outs = f_grad_shared(idlist)
+				cost, t = outs[:2]
+				if iters % args.main_update_freq == 0:
+					f_update(args.learning_rate)
+				
+				# subnetwork update
+				# not computed
+				cost_sg = np.nan
+				tmag = 'NC'
+				if iters % args.sub_update_freq == 0 and not np.isnan((t**2).mean()):
+					if args.async_sg:
+						# dropped if the trainer is too far behind
+						sg_trainer.submit(idlist, *outs[1:])
+					else:
+						cost_sg = sgd_update_sg(idlist, *outs[1:])
+						# f_update_sg(args.sg_learning_rate)
+						epoch_cost_sg += cost_sg
+				
+				elif np.isnan((t**2).mean()):
+					print "NaN encountered at", iters
+
+				if args.async_sg:
+					# newer subnetwork weights, the last cost of the trainer and the costs of its steps since the last check
+					sg_trainer.refresh()
+					steps, total, last = sg_trainer.stats
+					if steps > 0:
+						cost_sg = last
+					epoch_cost_sg += total - sg_total
+					sg_total = total
 			
 			# decay mode
+			sub_update_freq = args.sub_update_freq
 			if args.update_style == 'decay':
 				 if iters == 2000:
 				 	args.sub_update_freq = 2
@@ -632,10 +903,14 @@ if args.mode == 'train':
 				 	args.sub_update_freq = 50
 				 elif iters == 30000:
 			 		args.sub_update_freq = 100
+			if args.fused_step and args.sub_update_freq != sub_update_freq:
+				sub_freq.set_value(np.int64(args.sub_update_freq))
 			
 			epoch_cost += cost
 			min_cost = min(min_cost, cost)
-			cost_report.write(str(epoch) + ',' + str(batch_id) + ',' + str(cost) + ',' + str(cost_sg) + ',' + str(time.time() - batch_start) + '\n')
+			cost_report.log(epoch, batch_id, cost, cost_sg, time.time() - batch_start)
+			if stop.requested:
+				break
 
 			# partial REINITIALIZATION of the subnetwork to get it out of the local minima
 			# if iters == 1:
@@ -654,7 +929,29 @@ if args.mode == 'train':
 			# 	print "Entered in susceptible zone"
 			# 	flag = True
 		
-		print ": Cost " + str(epoch_cost) + " : SG Cost " + str(epoch_cost_sg) + " : Time " + str(time.time() - epoch_start)
+		if stop.requested:
+			print "\nStopping, saving the training state...",
+			if args.async_sg:
+				sg_trainer.close()
+			save_state(epoch, batch_id + 1, epoch_cost, epoch_cost_sg, batches.start_state)
+			checkpoints.close()
+			print "Done!"
+			sys.exit(143)
+
+		print ": Cost " + str(epoch_cost) + " : SG Cost " + str(epoch_cost_sg) + " : Time " + str(time.time() - epoch_start),
+		if args.async_sg:
+			print ": SG steps " + str(int(sg_trainer.stats[0])) + " : Dropped " + str(sg_trainer.dropped),
+		print
+		cost_report.flush()
+		first_batch = 0
+
+		# validation on the weights being trained, without leaving the process
+		if args.val_freq > 0 and (epoch + 1) % args.val_freq == 0:
+			val_start = time.time()
+			val_stats = evaluate(f_val, len(val_top), args.eval_chunk)
+			print "Validation : Cost " + str(val_stats.mean) + " +- " + str(val_stats.stderr()) + " : Time " + str(time.time() - val_start)
+			val_report.log(epoch, val_stats.mean, val_stats.stderr(), time.time() - val_start)
+			val_report.flush()
 		
 		# save every args.save_freq epochs
 		if (epoch + 1) % args.save_freq == 0:
@@ -665,8 +962,10 @@ if args.mode == 'train':
 				if not (('rmu' in key) or ('rvu' in key)):
 					params[key] = val.get_value()
 
-			# numpy saving
-			np.savez('./Results/' + args.latent_type + '/' + estimator + '/tsgd_' + code_name + '_' + str(args.batch_size) + '_' + str(init_rate) + '_' + str(epoch+1) + '.npz', **params)
+			# numpy saving, in the background
+			checkpoints.save('./Results/' + args.latent_type + '/' + estimator + '/tsgd_' + code_name + '_' + str(args.batch_size) + '_' + str(init_rate) + '_' + str(epoch+1) + '.npz', params)
+			# full training state, to continue with the next epoch
+			save_state(epoch + 1, 0, 0., 0., batches.end_state)
 			print "Done!"
 
 		epoch += 1
@@ -675,6 +974,13 @@ if args.mode == 'train':
 		elif args.term_condition == 'epochs' and epoch >= args.num_epochs:
 			condition = True
 
+	cost_report.close()
+	if args.val_freq > 0:
+		val_report.close()
+	if args.async_sg:
+		# the final weights include the steps still queued
+		sg_trainer.close()
+
 	# saving the final model
 	if epoch % args.save_freq != 0:
 		print "Saving...",
@@ -684,28 +990,36 @@ if args.mode == 'train':
 			if not (('rmu' in key) or ('rvu' in key)):
 				params[key] = val.get_value()
 
-		# numpy saving
-		np.savez('./Results/' + args.latent_type + '/' + estimator + '/tsgd_' + code_name + '_' + str(args.batch_size) + '_' + str(init_rate) + '_' + str(epoch) + '.npz', **params)
+		# numpy saving, in the background
+		checkpoints.save('./Results/' + args.latent_type + '/' + estimator + '/tsgd_' + code_name + '_' + str(args.batch_size) + '_' + str(init_rate) + '_' + str(epoch) + '.npz', params)
+		# full training state, the run can be continued with more epochs
+		save_state(epoch, 0, 0., 0., batches.end_state)
 		print "Done!"
 
+	checkpoints.close()
+
 # Test
 else:
-	loss = T.mean(T.nnet.binary_crossentropy(probs, gt))
+	# loss of every image averaged over args.num_samples latent samples, the test set is
+	# streamed through in chunks of args.eval_chunk images
+	losses = test_losses(tparams, img, gt, args.num_samples)
 	# pred = probs > 0.5
 
 	# compiling test function
-	inps = [img_ids]
-	f = theano.function(inps, [loss])
-	loss = f(range(len(tec)))
+	f = theano.function([img_ids], losses)
+	stats = evaluate(f, len(top), args.eval_chunk)
+	loss = [stats.mean, stats.stderr()]
 
 	# show(tec[idx].reshape(28,28))
 
 	# reconstructed_img = np.zeros((28*28,))
-	# reconstructed_img[:14*28] = tep[idx][0]
+	# reconstructed_img[:14*28] = top[idx]
 	# reconstructed_img[14*28:] = pred
 	# show(reconstructed_img.reshape(28,28))
 	if args.val_file is None:
-		print loss
+		print "Cost " + str(loss[0]) + " +- " + str(loss[1]) + " (" + str(stats.count) + " images, " + str(args.num_samples) + " samples each)"
 	else:
 		val_report = open(args.val_file, 'a')
+		# one value per line, the standard error is only printed
+		print "Cost " + str(loss[0]) + " +- " + str(loss[1]) + " (" + str(stats.count) + " images, " + str(args.num_samples) + " samples each)"
 		val_report.write(str(loss[0]) + '\n')
\ No newline at end of file
@@ -0,0 +1,312 @@
+import os
+import sys
+import glob
+import json
+import time
+import itertools
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+from distutils.spawn import find_executable
+import numpy as np
+import argparse
+
+from metrics import read_metrics, epoch_summary
+
+'''
+Runs a hyperparameter sweep of one of the training scripts on the local machine. The configurations are
+given in a json file, as a grid (every combination of the listed values) and/or a list of runs:
+
+{"script": "main.py", "fixed": {"num_epochs": 20},
+ "grid": {"estimator": ["SF", "PD"], "learning_rate": [0.001, 0.0002]},
+ "runs": [{"estimator": "SF", "repeat": 5}]}
+
+Keys are the long option names of the script. Every run gets its own base_code (the sweep name and the
+run number), which names its result files.
+
+Runs are scheduled over a fixed number of workers. Every worker owns its own set of the cores the sweep may run on
+(its affinity mask), and there are at most as many workers as fit on them: its runs are pinned
+to them (with taskset) and the BLAS/OpenMP thread pools are limited to the same number of threads, so that
+concurrent runs do not oversubscribe the CPU. A run is only started if the estimated memory of a run is available.
+Once a run ends, its metrics files are summarized into a results table (tab separated, one row per run).
+
+With successive halving, every run first trains for a few epochs. The runs are ranked by their last validation
+loss (or epoch cost), the worse ones are stopped and the others continue from their saved training state
+with a larger budget, until num_epochs is reached.
+'''
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------
+parser = argparse.ArgumentParser()
+parser.add_argument('config', type=str, help='Json file with the configurations of the sweep')
+parser.add_argument('-n', '--name', type=str, default=None, help='Name of the sweep, defaults to the name of the config file')
+parser.add_argument('-t', '--threads', type=int, default=1, help='Cores (and BLAS threads) per run')
+parser.add_argument('-w', '--workers', type=int, default=0, help='Concurrent runs, 0 uses every core')
+parser.add_argument('-m', '--memory', type=float, default=0.,
+					help='Memory budget of the sweep in GB, 0 uses the memory available when the sweep starts')
+parser.add_argument('-r', '--run_memory', type=float, default=1.,
+					help='Estimated peak memory of a run in GB')
+parser.add_argument('-o', '--output', type=str, default='Results/sweeps', help='Directory for the results table and the logs of the runs')
+parser.add_argument('-d', '--dry_run', type=int, default=0, help='Only print the commands of the runs')
+# successive halving
+parser.add_argument('-s', '--halving_epochs', type=int, default=0,
+					help='Epochs of the first round of successive halving, 0 trains every run for its num_epochs')
+parser.add_argument('-e', '--eta', type=float, default=2.,
+					help='Only the best 1/eta runs continue after a round, with a budget eta times larger')
+parser.add_argument('-k', '--rank_by', type=str, default='val',
+					help='Rank the runs by their last validation loss (val, needs val_freq) or by their last epoch cost (cost)')
+args = parser.parse_args()
+
+# environment variables read by the BLAS and OpenMP libraries numpy and theano may be linked with
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'GOTO_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------
+
+def available_memory():
+	'''
+	Memory available for new processes in GB (None if it cannot be read)
+	'''
+	try:
+		with open('/proc/meminfo') as f:
+			for line in f:
+				if line.startswith('MemAvailable:'):
+					return int(line.split()[1]) / 1024. ** 2
+	except IOError:
+		pass
+	return None
+
+def allowed_cores():
+	'''
+	Cores this process may run on (its affinity mask), all cores if it cannot be read
+	'''
+	try:
+		with open('/proc/self/status') as f:
+			for line in f:
+				if line.startswith('Cpus_allowed_list:'):
+					cores = []
+					for part in line.split()[1].split(','):
+						first, _, last = part.partition('-')
+						cores.extend(range(int(first), int(last or first) + 1))
+					return cores
+	except IOError:
+		pass
+	return list(range(multiprocessing.cpu_count()))
+
+def expand(config):
+	'''
+	List of the argument dicts of the runs in a sweep config
+	'''
+	fixed = config.get('fixed', {})
+	runs = []
+
+	grid = config.get('grid', {})
+	if len(grid) > 0:
+		keys = sorted(grid.keys())
+		for values in itertools.product(*[grid[key] for key in keys]):
+			run = dict(fixed)
+			run.update(zip(keys, values))
+			runs.append(run)
+
+	for extra in config.get('runs', []):
+		run = dict(fixed)
+		run.update(extra)
+		runs.append(run)
+
+	return runs
+
+def command(script, run):
+	cmd = [sys.executable, script]
+	for key in sorted(run.keys()):
+		cmd += ['--' + key, str(run[key])]
+	return cmd
+
+def summarize(code):
+	'''
+	Final and best values of the metrics files written by the run with base_code code
+	'''
+	summary = OrderedDict([('epochs', ''), ('final_cost', ''), ('best_cost', ''), ('final_val', ''), ('val_stderr', ''), ('best_val', '')])
+	for fname in glob.glob('Results/*/*/*_' + code + '_*.bin'):
+		try:
+			header, records = read_metrics(fname)
+		except (IOError, ValueError, KeyError):
+			continue
+
+		if 'cost' in records and len(records['cost']) > 0:
+			# mean cost of a minibatch in every epoch
+			costs = epoch_summary(records, 'cost', percentiles=())
+			summary['epochs'] = len(costs['epoch'])
+			summary['final_cost'] = costs['mean'][-1]
+			summary['best_cost'] = costs['mean'].min()
+		elif 'loss' in records and len(records['loss']) > 0:
+			summary['final_val'] = records['loss'][-1]
+			if 'stderr' in records:
+				summary['val_stderr'] = records['stderr'][-1]
+			summary['best_val'] = records['loss'].min()
+
+	return summary
+
+def write_table(fname, runs, results):
+	'''
+	Results of the finished runs, with the arguments that vary across the sweep
+	'''
+	varying = sorted(key for key in set(itertools.chain(*runs)) if len(set(repr(run.get(key)) for run in runs)) > 1)
+	with open(fname, 'w') as f:
+		columns = None
+		for i in sorted(results.keys()):
+			result = results[i]
+			if columns is None:
+				columns = ['run', 'status', 'time', 'rounds'] + varying + result['summary'].keys()
+				f.write('\t'.join(columns) + '\n')
+			row = [str(i), str(result['status']), '%.1f' % result['time'], str(result['rounds'])] + [str(runs[i].get(key, '')) for key in varying]
+			f.write('\t'.join(row + [str(value) for value in result['summary'].values()]) + '\n')
+
+# ---------------------------------------------------------------------------------------------------------------------------------------------------------
+with open(args.config) as f:
+	config = json.load(f)
+
+name = args.name or os.path.splitext(os.path.basename(args.config))[0]
+script = config.get('script', 'main.py')
+if not os.path.exists(script):
+	# scripts are found next to this one when the sweep is started from elsewhere
+	script = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+
+runs = expand(config)
+for i, run in enumerate(runs):
+	run['base_code'] = name + str(i)
+
+cores = allowed_cores()
+if args.threads > len(cores):
+	print "Only " + str(len(cores)) + " cores are available, runs use " + str(len(cores)) + " threads instead of " + str(args.threads)
+	args.threads = len(cores)
+max_workers = len(cores) // args.threads
+workers = args.workers if args.workers > 0 else max_workers
+if workers > max_workers:
+	print "Only " + str(len(cores)) + " cores are available for " + str(args.workers) + " workers of " + str(args.threads) + " threads, using " + str(max_workers) + " workers"
+	workers = max_workers
+memory = args.memory if args.memory > 0 else available_memory()
+if memory is not None:
+	workers = max(1, min(workers, int(memory // args.run_memory)))
+
+# cores of every worker, runs on different workers never share one
+taskset = find_executable('taskset')
+core_sets = [cores[w * args.threads:(w + 1) * args.threads] for w in range(workers)]
+
+print "Sweep " + name + ": " + str(len(runs)) + " runs of " + script + " : Workers " + str(workers) + " x " + str(args.threads) + " threads"
+if taskset is None:
+	print "taskset was not found, the runs are not pinned to cores"
+
+if args.dry_run:
+	for i, run in enumerate(runs):
+		print i, ' '.join(command(script, run))
+	sys.exit(0)
+
+log_dir = os.path.join(args.output, name)
+if not os.path.isdir(log_dir):
+	os.makedirs(log_dir)
+table = os.path.join(args.output, name + '.tsv')
+
+env = dict(os.environ)
+for var in THREAD_VARIABLES:
+	env[var] = str(args.threads)
+
+results = {}
+
+def schedule(indices, budget=None, resume=0):
+	'''
+	Runs the given runs over the workers and records their results when they end. With a budget (successive halving),
+	a run trains up to that epoch or its own num_epochs, whichever comes first, resuming from its saved state with resume.
+	'''
+	pending = list(indices)
+	running = {}
+	free = list(range(workers))
+
+	try:
+		while len(pending) > 0 or len(running) > 0:
+			# start runs on the free workers, as long as memory is left for them
+			while len(pending) > 0 and len(free) > 0:
+				mem = available_memory()
+				if len(running) > 0 and mem is not None and mem < args.run_memory:
+					break
+
+				i = pending.pop(0)
+				worker = free.pop(0)
+				run = dict(runs[i])
+				if budget is not None:
+					run.update({'num_epochs': min(budget, runs[i]['num_epochs']), 'resume': resume})
+				cmd = command(script, run)
+				if taskset is not None:
+					cmd = [taskset, '-c', ','.join(str(c) for c in core_sets[worker])] + cmd
+
+				# the logs of later rounds are appended to the first one
+				log = open(os.path.join(log_dir, runs[i]['base_code'] + '.log'), 'a' if i in results else 'w')
+				log.write(' '.join(cmd) + '\n')
+				log.flush()
+				proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+				running[proc] = (i, worker, log, time.time())
+				print "Started run " + str(i) + " on cores " + ','.join(str(c) for c in core_sets[worker])
+
+			time.sleep(1.)
+
+			for proc in running.keys():
+				status = proc.poll()
+				if status is None:
+					continue
+
+				i, worker, log, start = running.pop(proc)
+				log.close()
+				free.append(worker)
+				result = results.setdefault(i, {'time': 0., 'rounds': 0})
+				result['status'] = status
+				result['time'] += time.time() - start
+				result['rounds'] += 1
+				result['summary'] = summarize(runs[i]['base_code'])
+				# the table is rewritten after every run, an interrupted sweep keeps the finished ones
+				write_table(table, runs, results)
+				print "Finished run " + str(i) + " : Status " + str(status) + " : Time " + str(result['time'])
+
+	except KeyboardInterrupt:
+		# the training scripts save their state on SIGTERM, the runs can be resumed with their --resume option
+		print "Stopping the running runs"
+		for proc in running:
+			proc.terminate()
+		for proc in running:
+			proc.wait()
+		sys.exit(1)
+
+def score(i):
+	'''
+	Rank of a run after a round of successive halving, lower is better. Failed and diverged runs come last.
+	'''
+	result = results[i]
+	summary = result['summary']
+	value = summary['final_val'] if args.rank_by == 'val' and summary['final_val'] != '' else summary['final_cost']
+	if result['status'] != 0 or value == '' or not np.isfinite(value):
+		return np.inf
+	return value
+
+sweep_start = time.time()
+
+if args.halving_epochs <= 0:
+	schedule(range(len(runs)))
+else:
+	# successive halving: every round trains the remaining runs up to the epoch budget, then only the best
+	# 1/eta of them continue (from their saved training state) with a budget eta times larger
+	if any('num_epochs' not in run for run in runs):
+		raise ValueError, "Successive halving needs the num_epochs of every run in the config"
+	max_epochs = max(run['num_epochs'] for run in runs)
+	survivors = range(len(runs))
+	budget = args.halving_epochs
+	resume = 0
+	while True:
+		budget = min(budget, max_epochs)
+		print "Round with " + str(len(survivors)) + " runs, up to epoch " + str(budget)
+		# runs whose own num_epochs is reached are not continued
+		active = [i for i in survivors if i not in results or results[i]['summary']['epochs'] < runs[i]['num_epochs']]
+		schedule(active, budget, resume)
+		if budget >= max_epochs:
+			break
+
+		ranked = sorted(survivors, key=score)
+		survivors = ranked[:max(1, int(np.ceil(len(ranked) / args.eta)))]
+		print "Pruned runs " + ', '.join(str(i) for i in sorted(ranked[len(survivors):]))
+		budget = int(np.ceil(budget * args.eta))
+		resume = 1
+
+print "Sweep done : Time " + str(time.time() - sweep_start) + " : Results in " + table
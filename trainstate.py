@@ -0,0 +1,60 @@
+import cPickle
+import signal
+
+'''
+Training state for exact resumption. Besides the parameters, a run depends on state that lives in
+anonymous shared variables (adam moments and step counter, SGD momentum, batchnorm statistics, random
+streams) and on the counters of the training loop. The shared variables are found through the updates
+of the compiled training functions, so every script gets them without naming them one by one.
+'''
+
+def state_variables(functions):
+	'''
+	Shared variables updated by the given compiled functions, in a stable order
+	(the graphs are built the same way on every run)
+	'''
+	variables = []
+	for f in functions:
+		for inp in f.maker.inputs:
+			if inp.update is not None and inp.variable not in variables:
+				variables.append(inp.variable)
+
+	return variables
+
+def capture(variables, loop, batches):
+	'''
+	Snapshot of the training state: values of the shared variables, the loop counters (dict)
+	and the random state of the minibatch iterator
+	'''
+	return {'names': [str(var) for var in variables],
+			'values': [var.get_value() for var in variables],
+			'loop': dict(loop),
+			'batches': batches}
+
+def load(fname):
+	with open(fname, 'rb') as f:
+		return cPickle.load(f)
+
+def restore(variables, state):
+	'''
+	Sets the shared variables from a state returned by capture, returns the loop counters and the random state of the minibatch iterator
+	'''
+	if state['names'] != [str(var) for var in variables]:
+		raise ValueError, "The saved state does not match the training functions of this configuration"
+
+	for var, value in zip(variables, state['values']):
+		var.set_value(value)
+
+	return state['loop'], state['batches']
+
+class StopRequest():
+	'''
+	Turns SIGTERM into a flag that the training loop checks between steps, so that the state can
+	be written from a consistent point before exiting
+	'''
+	def __init__(self):
+		self.requested = False
+		signal.signal(signal.SIGTERM, self._handler)
+
+	def _handler(self, signum, frame):
+		self.requested = True
@@ -1,6 +1,11 @@
 import cPickle as pickle
+import time
 import numpy as np
+import theano
 import theano.tensor as T
+from theano.ifelse import ifelse
+
+from collections import OrderedDict
 
 # general function to save python objects using pickle
 def save_obj(obj, address):
@@ -29,4 +34,60 @@ def _concat(str1, str2):
 	'''
 	Returns str1_str2
 	'''
-	return '%s_%s' % (str1,str2)
\ No newline at end of file
+	return '%s_%s' % (str1,str2)
+
+def compile_multistep(inp, outputs, updates, num_steps):
+	'''
+	Compiles a function running num_steps consecutive steps of a training function in one call.
+	Every input gets an extra leading axis of size num_steps and every output is returned stacked over the steps.
+	The graph is unrolled, feeding the updated shared variables of each step (parameters, optimizer state,
+	running averages and random states) into the next one.
+	'''
+	updates = OrderedDict(updates)
+
+	# random streams advance their state through default updates, which have to be threaded as well
+	for var in theano.gof.graph.inputs(list(outputs) + updates.values()):
+		if getattr(var, 'default_update', None) is not None and var not in updates:
+			updates[var] = var.default_update
+
+	state = updates.keys()
+	blocks = [T.TensorType(x.dtype, (False,) + x.broadcastable)(x.name) for x in inp]
+
+	current = OrderedDict()
+	step_outputs = []
+	for k in range(num_steps):
+		replace = OrderedDict(current)
+		for x, block in zip(inp, blocks):
+			replace[x] = block[k]
+
+		new = theano.clone(list(outputs) + [updates[s] for s in state], replace=replace)
+		step_outputs.append(new[:len(outputs)])
+		current = OrderedDict(zip(state, new[len(outputs):]))
+
+	stacked = [T.stack(list(outs)) for outs in zip(*step_outputs)]
+	return theano.function(blocks, stacked, updates=current.items(), on_unused_input='ignore', allow_input_downcast=True, profile=False)
+
+def gated_updates(cond, updates):
+	'''
+	Updates (list of tuples) applied only when the symbolic scalar cond is true, the variables keep their values otherwise.
+	The new values are evaluated lazily, their computation is skipped along with the update.
+	'''
+	variables = [var for var, new in updates]
+	return zip(variables, ifelse(cond, [new for var, new in updates], variables))
+
+class PhaseTimer():
+	'''
+	Wall clock time of the startup phases of a script. mark(name) closes the phase that
+	started at the previous mark, time spent in phases with the same name is added up.
+	'''
+	def __init__(self):
+		self.phases = OrderedDict()
+		self.last = time.time()
+
+	def mark(self, name):
+		now = time.time()
+		self.phases[name] = self.phases.get(name, 0.) + now - self.last
+		self.last = now
+
+	def report(self):
+		print "Startup: " + " : ".join(name + " %.2fs" % (t) for name, t in self.phases.iteritems()) + " : Total %.2fs" % (sum(self.phases.values()))